@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+# run every stage of the pipeline on a synthetic cred file against fake_server.py, timing each one
+#
+# ./benchmark_pipeline.py [--lines N] [--seed N] [--input FILE] [--workdir DIR] [--port N] [--shards N]
+#     [--server-args ARGS] [--stages NAME,NAME,...] [--output FILE] [--baseline FILE] [--tolerance F]
+#
+# the cred file is written by generate_cred_file.py with --lines and --seed, unless --input names an
+# existing one.  Each stage runs as its own process in --workdir, with $PIPELINE_CONFIG pointing it at a
+# fake_server.py started on --port (with --server-args, e.g. '--latency 2 --jitter 1') and --shards
+# blocks_sharded dbs.  For every stage this records the wall time, rows/s, the CPU time and peak RSS of
+# the process, the number of requests of each kind that the server got, and the retries from the stage's
+# own --metrics file.  Rows are the lines of the cred file for the stages that read it, and the docs
+# written for the others.
+#
+# results are printed and written to --output as JSON.  With --baseline, they're compared to an earlier
+# --output, and any stage whose rows/s dropped by more than --tolerance is reported as a regression.
+#
+
+import sys, os, json, time, getopt, subprocess, shlex
+import requests
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_START_TIMEOUT = 30 # seconds
+
+# (name, arguments, what its rows are: 'lines' of the cred file, or the dbs whose docs it writes)
+STAGES = [\
+    ('load_cred_file', ['--db', 'csv'], 'lines'),\
+    ('compute_couchdb_from_csv', ['--input', 'csv', '--routing', 'hash'], 'lines'),\
+    ('compute_block_ids_db', ['--index-output', 'block_ids.index'], ['block_ids']),\
+    ('compute_optimized_couchdb', ['--routing', 'hash', '--block-ids-index', 'block_ids.index'],\
+        ['block_summaries3', 'related_blocks3', 'block_hints3']),\
+    ('compute_mini_block_hints', ['--mode', 'pipelined'], ['mini_block_hints']),\
+    ('index_docs_in_solr', ['--state', 'index_docs_in_solr.state'], ['solr']),\
+    ]
+
+args = {'--lines' : '100000', '--seed' : '0', '--input' : None, '--workdir' : 'benchmark', '--port' : '5990',\
+    '--shards' : '3', '--server-args' : '', '--stages' : ','.join(stage[0] for stage in STAGES),\
+    '--output' : 'benchmark.json', '--baseline' : None, '--tolerance' : '0.2'}
+args.update(dict(getopt.getopt(sys.argv[1:], '', ['lines=', 'seed=', 'input=', 'workdir=', 'port=', 'shards=',\
+    'server-args=', 'stages=', 'output=', 'baseline=', 'tolerance='])[0]))
+
+workdir = os.path.abspath(args['--workdir'])
+server_url = 'http://127.0.0.1:%d' % int(args['--port'])
+num_shards = int(args['--shards'])
+stage_names = args['--stages'].split(',')
+tolerance = float(args['--tolerance'])
+
+unknown_stages = set(stage_names) - set(stage[0] for stage in STAGES)
+if unknown_stages:
+  sys.exit('unknown stages: %s' % ', '.join(sorted(unknown_stages)))
+
+def write_config():
+  # the scripts disagree on the names of the optimized dbs, so point the readers at what the writers write
+  config = {
+    'couchdb' : server_url,
+    'shards' : ['%s/blocks_sharded%d' % (server_url, i) for i in range(num_shards)],
+    'solr' : server_url + '/solr',
+    'db_names' : {'block_summaries' : 'block_summaries3', 'related_blocks' : 'related_blocks3',\
+        'block_hints' : 'block_hints3'},
+    }
+  filename = os.path.join(workdir, 'pipeline_config.json')
+  with open(filename, 'w') as f:
+    json.dump(config, f, indent=2)
+  return filename
+
+def prepare_input():
+  cred_filename = os.path.join(workdir, 'cred')
+  if os.path.lexists(cred_filename):
+    os.remove(cred_filename)
+  if args['--input']:
+    os.symlink(os.path.abspath(args['--input']), cred_filename)
+  else:
+    if run_script('generate_cred_file.py', ['--lines', args['--lines'], '--seed', args['--seed']],\
+        'generate_cred_file.log')[0] != 0:
+      sys.exit('could not generate the cred file')
+  with open(cred_filename, 'rb') as f:
+    return sum(1 for line in f)
+
+def run_script(script, script_args, log_name, env=None):
+  # returns (exit status, wall time, resource usage) of the script, run to completion
+  with open(os.path.join(workdir, log_name), 'w') as log:
+    start_time = time.time()
+    process = subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIR, script)] + script_args,\
+        cwd=workdir, stdout=log, stderr=subprocess.STDOUT, env=env)
+    # wait4 gives the resource usage of this one child, rather than the maximum over all of them
+    (pid, status, rusage) = os.wait4(process.pid, 0)
+    elapsed = time.time() - start_time
+  status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+  if status != 0:
+    print 'ERROR: %s exited with status %d, see %s' % (script, status, os.path.join(workdir, log_name))
+  return (status, elapsed, rusage)
+
+def start_server():
+  server = subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIR, 'fake_server.py'), '--port', args['--port']] +\
+      shlex.split(args['--server-args']), stdout=open(os.path.join(workdir, 'fake_server.log'), 'w'),\
+      stderr=subprocess.STDOUT)
+  deadline = time.time() + SERVER_START_TIMEOUT
+  while True:
+    try:
+      requests.get(server_url + '/_stats')
+      return server
+    except requests.exceptions.ConnectionError:
+      if server.poll() is not None or time.time() > deadline:
+        server.kill()
+        sys.exit('fake_server.py did not start, see %s' % os.path.join(workdir, 'fake_server.log'))
+      time.sleep(0.1)
+
+def count_rows(rows, num_lines, server_stats):
+  if rows == 'lines':
+    return num_lines
+  return sum(server_stats['solr_docs'] if db == 'solr' else server_stats['dbs'].get(db, 0) for db in rows)
+
+def count_retries(metrics_filename):
+  try:
+    with open(metrics_filename) as f:
+      snapshot = json.load(f)
+  except (IOError, ValueError):
+    return None
+  return sum(counter['value'] for counter in snapshot['counters'] if counter['name'] == 'http_retries_total')
+
+def run_stage((name, stage_args, rows), num_lines, env):
+  requests.delete(server_url + '/_stats')
+  metrics_filename = os.path.join(workdir, name + '.metrics.json')
+  (status, elapsed, rusage) = run_script(name + '.py', stage_args + ['--metrics', metrics_filename], name + '.log', env)
+  server_stats = requests.get(server_url + '/_stats').json()
+
+  # leaving out the requests for the stats themselves
+  request_counts = dict((kind, kind_stats['requests']) for (kind, kind_stats) in server_stats.iteritems()\
+      if isinstance(kind_stats, dict) and 'requests' in kind_stats and kind != 'stats')
+  num_rows = count_rows(rows, num_lines, server_stats)
+  return {
+    'stage' : name,
+    'status' : status,
+    'seconds' : elapsed,
+    'rows' : num_rows,
+    'rows_per_second' : num_rows / max(elapsed, 1e-6),
+    'cpu_seconds' : rusage.ru_utime + rusage.ru_stime,
+    'max_rss_kb' : rusage.ru_maxrss,
+    'requests' : request_counts,
+    'total_requests' : sum(request_counts.values()),
+    'retries' : count_retries(metrics_filename),
+    }
+
+def print_results(results):
+  print '%-28s %6s %10s %10s %10s %12s %10s %10s %8s' %\
+      ('stage', 'status', 'seconds', 'cpu', 'rows', 'rows/s', 'RSS MB', 'requests', 'retries')
+  for result in results:
+    print '%-28s %6d %10.2f %10.2f %10d %12.0f %10.1f %10d %8s' % (result['stage'], result['status'], result['seconds'],\
+        result['cpu_seconds'], result['rows'], result['rows_per_second'], result['max_rss_kb'] / 1024.0,\
+        result['total_requests'], result['retries'])
+
+def compare_to_baseline(results, baseline_filename):
+  with open(baseline_filename) as f:
+    baseline = dict((result['stage'], result) for result in json.load(f)['stages'])
+  regressions = []
+  print 'compared to %s:' % baseline_filename
+  for result in results:
+    if result['stage'] not in baseline:
+      continue
+    old = baseline[result['stage']]
+    ratio = result['rows_per_second'] / max(old['rows_per_second'], 1e-6)
+    flag = ''
+    if ratio < 1 - tolerance:
+      flag = '  REGRESSION'
+      regressions.append(result['stage'])
+    print '%-28s rows/s %12.0f -> %12.0f (%+.1f%%), RSS %8.1f -> %8.1f MB, requests %8d -> %8d%s' %\
+        (result['stage'], old['rows_per_second'], result['rows_per_second'], (ratio - 1) * 100,\
+        old['max_rss_kb'] / 1024.0, result['max_rss_kb'] / 1024.0, old['total_requests'], result['total_requests'], flag)
+  return regressions
+
+def main():
+  if not os.path.isdir(workdir):
+    os.makedirs(workdir)
+
+  num_lines = prepare_input()
+  print 'benchmarking %s on %d lines in %s' % (', '.join(stage_names), num_lines, workdir)
+
+  env = dict(os.environ, PIPELINE_CONFIG=write_config())
+  server = start_server()
+  results = []
+  try:
+    for stage in STAGES:
+      if stage[0] not in stage_names:
+        continue
+      result = run_stage(stage, num_lines, env)
+      print '%s took %.2fs, %.0f rows/s' % (stage[0], result['seconds'], result['rows_per_second'])
+      results.append(result)
+      if result['status'] != 0:
+        break # the later stages need this one's output
+  finally:
+    server.terminate()
+    server.wait()
+
+  print_results(results)
+  with open(args['--output'], 'w') as f:
+    json.dump({'lines' : num_lines, 'seed' : int(args['--seed']), 'input' : args['--input'],\
+        'server_args' : args['--server-args'], 'shards' : num_shards, 'stages' : results}, f, indent=2)
+  print 'wrote results to %s' % args['--output']
+
+  failed = any(result['status'] != 0 for result in results)
+  regressions = compare_to_baseline(results, args['--baseline']) if args['--baseline'] else []
+  if failed or regressions:
+    sys.exit(1)
+
+if __name__=='__main__':
+  main()
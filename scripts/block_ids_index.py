@@ -0,0 +1,79 @@
+#
+# on-disk, sorted (block, int id) index, written by compute_block_ids_db.py and read by
+# compute_optimized_couchdb.py instead of loading the whole block_ids db into a dict
+#
+# layout (little-endian): header, then fixed-width records sorted by block: the block, padded with
+# NUL bytes to KEY_SIZE, followed by its uint32 int id.  The file is memory-mapped, so lookups are a
+# binary search and any number of processes can share one copy of the pages.
+#
+
+import mmap, struct
+
+MAGIC = 'BLKIDS01'
+HEADER_FORMAT = '<8sQI'
+KEY_SIZE = 11
+
+def pack_block(block):
+  if isinstance(block, unicode):
+    block = block.encode('utf-8')
+  if len(block) > KEY_SIZE:
+    raise ValueError('block %r is longer than %d bytes' % (block, KEY_SIZE))
+  return block.ljust(KEY_SIZE, '\0')
+
+def write_block_ids_index(filename, blocks_and_ids):
+  records = sorted([(pack_block(block), int_id) for (block, int_id) in blocks_and_ids])
+  with open(filename, 'wb') as f:
+    f.write(struct.pack(HEADER_FORMAT, MAGIC, len(records), KEY_SIZE))
+    for (packed_block, int_id) in records:
+      f.write(packed_block + struct.pack('<I', int_id))
+
+class BlockIdsIndex(object):
+
+  def __init__(self, filename):
+    self.file = open(filename, 'rb')
+    self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    (magic, self.num_records, key_size) = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+    if magic != MAGIC or key_size != KEY_SIZE:
+      raise ValueError('%s is not a block ids index' % filename)
+    
+    self.start = struct.calcsize(HEADER_FORMAT)
+    self.record_size = KEY_SIZE + 4
+
+  def __len__(self):
+    return self.num_records
+
+  def key_at(self, i):
+    offset = self.start + i * self.record_size
+    return self.mm[offset:offset + KEY_SIZE]
+
+  def id_at(self, i):
+    return struct.unpack_from('<I', self.mm, self.start + i * self.record_size + KEY_SIZE)[0]
+
+  def __getitem__(self, i):
+    # (block, int id) at the given position, or a list of them for a slice, in block order
+    if isinstance(i, slice):
+      return [self[j] for j in xrange(*i.indices(self.num_records))]
+    if i < 0:
+      i += self.num_records
+    if i < 0 or i >= self.num_records:
+      raise IndexError(i)
+    return (self.key_at(i).rstrip('\0'), self.id_at(i))
+
+  def lookup(self, block):
+    # binary search; returns None if the block isn't in the index
+    key = pack_block(block)
+    (lo, hi) = (0, self.num_records)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.key_at(mid) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < self.num_records and self.key_at(lo) == key:
+      return self.id_at(lo)
+    return None
+
+  def close(self):
+    self.mm.close()
+    self.file.close()
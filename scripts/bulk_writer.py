@@ -0,0 +1,198 @@
+#
+# _bulk_docs writer that cuts batches by payload size rather than by number of docs, and tunes
+# itself from how CouchDB responds
+#
+# request bodies are streamed, encoding docs one at a time as they're sent, so peak memory depends on
+# the number of posts in flight rather than on the batch size.
+# the byte budget and the number of posts in flight follow AIMD: after a successful post that came back
+# within TARGET_LATENCY, both grow a little; a slow post shrinks the concurrency, and a 413 (too large),
+# a 5xx or a connection error halves both.  A batch that failed is split in half and retried.
+#
+# the current budget and concurrency of every writer are kept as gauges in metrics.py, along with
+# counts of the docs written and the batches split.
+#
+
+import json, time, collections
+import requests
+import gevent
+from gevent.event import AsyncResult
+import couchdb_client, metrics
+
+MIN_BATCH_BYTES = 64 * 1024
+INITIAL_BATCH_BYTES = 1024 * 1024
+MAX_BATCH_BYTES = 32 * 1024 * 1024
+BATCH_BYTES_STEP = 256 * 1024
+TARGET_LATENCY = 5.0 # seconds
+NUM_RETRIES = 10
+FAST_JSON = True # use ujson to encode docs when it's installed
+
+class BulkWriteError(Exception):
+  pass
+
+def get_encoder(fast_json):
+  # ujson is a lot faster than the json module, if it's installed
+  if fast_json:
+    try:
+      import ujson
+      return ujson.dumps
+    except ImportError:
+      pass
+  return json.JSONEncoder(separators=(',',':')).encode
+
+class BatchBody(object):
+  # request body that is encoded one doc at a time while it's being sent (chunked transfer encoding),
+  # so that a whole batch never sits in memory as one big string.  It covers docs[start:end], or, if
+  # end is None, as many docs from start as fit in the byte budget (always at least one).
+
+  def __init__(self, docs, start, end, budget, encode):
+    self.docs = docs
+    self.start = start
+    self.end = len(docs) if end is None else end
+    self.budget = budget
+    self.encode = encode
+    self.count = 0
+    self.size = 0
+    self.finish_event = AsyncResult()
+
+  def __iter__(self):
+    yield '{"docs":['
+    self.size = len('{"docs":[]}')
+    for i in xrange(self.start, self.end):
+      if self.budget is not None and self.count > 0 and self.size >= self.budget:
+        break
+      chunk = self.encode(self.docs[i]) if self.count == 0 else ',' + self.encode(self.docs[i])
+      self.size += len(chunk)
+      self.count += 1
+      yield chunk
+    yield ']}'
+    self.finish()
+
+  def finish(self):
+    # returns the number of docs in this body, fixing it if the body never got to be fully sent
+    if not self.finish_event.ready():
+      self.finish_event.set(max(1, self.count))
+    return self.finish_event.get()
+
+class BulkWriter(object):
+
+  def __init__(self, url, max_concurrency=4, initial_bytes=INITIAL_BATCH_BYTES, fast_json=FAST_JSON):
+    self.url = url
+    self.metrics_db = couchdb_client.endpoint_name(url)
+    self.encode = get_encoder(fast_json)
+    self.max_concurrency = max_concurrency
+    self.concurrency = float(max_concurrency)
+    self.batch_bytes = initial_bytes
+    self.in_flight = 0
+    self.waiters = collections.deque()
+
+  def acquire(self):
+    while self.in_flight >= max(1, int(self.concurrency)):
+      waiter = AsyncResult()
+      self.waiters.append(waiter)
+      waiter.get()
+    self.in_flight += 1
+
+  def release(self):
+    self.in_flight -= 1
+    if self.waiters:
+      self.waiters.popleft().set()
+
+  def record_settings(self):
+    metrics.set_gauge('bulk_batch_bytes', self.batch_bytes, db=self.metrics_db)
+    metrics.set_gauge('bulk_concurrency', int(self.concurrency), db=self.metrics_db)
+
+  def succeeded(self, latency):
+    if latency <= TARGET_LATENCY:
+      self.batch_bytes = min(MAX_BATCH_BYTES, self.batch_bytes + BATCH_BYTES_STEP)
+      self.concurrency = min(self.max_concurrency, self.concurrency + 0.5)
+    else:
+      self.concurrency = max(1.0, self.concurrency * 0.75)
+    self.record_settings()
+
+  def failed(self, batch_bytes):
+    self.batch_bytes = max(MIN_BATCH_BYTES, min(self.batch_bytes, batch_bytes) / 2)
+    self.concurrency = max(1.0, self.concurrency / 2)
+    self.record_settings()
+
+  def post_batch(self, docs, body, results, errors, attempt=0):
+    start_time = time.time()
+    try:
+      # the retrying happens here, so that the batch can be split up in between
+      response = couchdb_client.post(self.url + '/_bulk_docs', data=body, headers={'Content-Type':'application/json'},\
+          num_retries=0, retry_status_codes=())
+      status_code = response.status_code
+    except requests.exceptions.ConnectionError:
+      status_code = None
+    latency = time.time() - start_time
+    (start, end) = (body.start, body.start + body.finish())
+
+    if status_code in (201, 202):
+      self.succeeded(latency)
+      results += response.json()
+      metrics.inc('bulk_docs_written_total', end - start, db=self.metrics_db)
+      print " > posted %d docs (%d bytes) to %s in %.2fs, batch size now %d bytes, concurrency %d" %\
+          (end - start, body.size, self.url, latency, self.batch_bytes, int(self.concurrency))
+      return
+
+    if status_code is not None and status_code != 413 and status_code < 500:
+      errors.append("got response %d from %s: %s" % (status_code, self.url, response.text))
+      return
+    if attempt == NUM_RETRIES:
+      errors.append("gave up posting %d docs to %s, last response %s" % (end - start, self.url, status_code))
+      return
+
+    self.failed(body.size)
+    metrics.inc('bulk_batches_split_total', db=self.metrics_db)
+    print " > got response %s posting %d docs (%d bytes) to %s, batch size now %d bytes, concurrency %d" %\
+        (status_code, end - start, body.size, self.url, self.batch_bytes, int(self.concurrency))
+    if status_code != 413:
+      gevent.sleep(couchdb_client.backoff(attempt))
+
+    if end - start == 1:
+      self.post_batch(docs, BatchBody(docs, start, end, None, self.encode), results, errors, attempt + 1)
+    else:
+      middle = (start + end) / 2
+      self.post_batch(docs, BatchBody(docs, start, middle, None, self.encode), results, errors, attempt + 1)
+      self.post_batch(docs, BatchBody(docs, middle, end, None, self.encode), results, errors, attempt + 1)
+
+  def write(self, docs):
+    # posts all of the docs and returns CouchDB's per-doc results; raises BulkWriteError if any
+    # batch couldn't be posted
+    results = []
+    errors = []
+
+    def post_and_release(body):
+      try:
+        self.post_batch(docs, body, results, errors)
+      finally:
+        body.finish()
+        self.release()
+
+    # a batch ends wherever its body runs out of budget, so the next batch can only start once the
+    # previous body has been sent; waiting for the responses still overlaps
+    greenlets = []
+    start = 0
+    while start < len(docs):
+      self.acquire()
+      body = BatchBody(docs, start, None, self.batch_bytes, self.encode)
+      greenlets.append(gevent.spawn(post_and_release, body))
+      start += body.finish_event.get()
+    gevent.joinall(greenlets)
+    
+    # anything post_batch didn't handle itself (e.g. a response that isn't JSON) fails the write too
+    errors += ["error posting to %s: %r" % (self.url, greenlet.exception) for greenlet in greenlets\
+        if not greenlet.successful()]
+
+    if errors:
+      raise BulkWriteError('; '.join(errors))
+    return results
+
+writers = {}
+
+def get_writer(url, max_concurrency=4):
+  # one writer per url, so that everything posting to the same db shares its budget and concurrency
+  try:
+    return writers[url]
+  except KeyError:
+    writer = writers[url] = BulkWriter(url, max_concurrency)
+    return writer
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# check that index_docs_in_solr.py --hint-weighting termfreq gives every term of a doc the same term
+# frequency as --hint-weighting repeat, on the real hint maps in CouchDB, as analyzed by a real Solr
+#
+# ./check_hint_weighting.py [--docs N] [--dbs NAME,NAME,...]
+#
+# reads the first --docs docs with hints from each of --dbs, and has the Solr of pipeline_config.py
+# (which needs solr/schema.xml, and so Solr 7 or later) run both through its index analyzers with
+# /analysis/field, which indexes nothing:
+#
+#   repeat: all of the doc's hints, one per line, through the hints field (StandardTokenizer and
+#   friends).  Every term counts once for each time its hint is repeated, found by its offset.
+#
+#   termfreq: the one "token|frequency" value index_docs_in_solr.py would send, through the hints_tf
+#   field, whose DelimitedTermFrequencyTokenFilter sets each term's frequency.
+#
+# any doc whose terms or frequencies differ (e.g. because hint_weighting.tokenize() splits a hint
+# differently from StandardTokenizer) is printed, and the script exits with 1.  It also prints how much
+# smaller the termfreq docs are.
+#
+
+import json, sys, bisect, getopt
+import couchdb_client, couchdb_rows, hint_weighting, pipeline_config
+
+MAX_MISMATCHES_SHOWN = 10
+
+args = {'--docs' : '1000', '--dbs' : 'block_summaries,related_blocks'}
+args.update(dict(getopt.getopt(sys.argv[1:], '', ['docs=', 'dbs='])[0]))
+
+num_docs = int(args['--docs'])
+db_urls = [pipeline_config.couchdb_url(db_name) for db_name in args['--dbs'].split(',')]
+SOLR_URL = pipeline_config.solr_url()
+
+def analyze(field, value):
+  # the tokens that come out of the last step of field's index analyzer
+  params = {'analysis.fieldname' : field, 'analysis.fieldvalue' : value, 'wt' : 'json', 'json.nl' : 'flat'}
+  response = couchdb_client.post(SOLR_URL + '/analysis/field', data=params)
+  if response.status_code != 200:
+    sys.exit("got response %d from %s: %s" % (response.status_code, response.url, response.text[:1000]))
+  steps = response.json()['analysis']['field_names'][field]['index']
+  return steps[-1] # [name, tokens, name, tokens, ...]
+
+def utf16_length(text):
+  # Solr's offsets count UTF-16 code units
+  return len(text.encode('utf-16-le')) / 2
+
+def repeat_frequencies(hint_map):
+  hints = hint_map.keys()
+  starts = []
+  position = 0
+  for hint in hints:
+    starts.append(position)
+    position += utf16_length(hint) + 1
+
+  frequencies = {}
+  for token in analyze('hints', u'\n'.join(hints)):
+    hint = hints[bisect.bisect_right(starts, token['start']) - 1]
+    frequencies[token['text']] = frequencies.get(token['text'], 0) + hint_map[hint]
+  return frequencies
+
+def term_frequency(token):
+  # TermFrequencyAttribute, under whichever name this Solr reports it
+  for (key, value) in token.items():
+    if key == 'termFrequency' or key.endswith('#termFrequency'):
+      return value
+  return 1
+
+def termfreq_frequencies(hint_map):
+  frequencies = {}
+  for token in analyze('hints_tf', hint_weighting.term_frequency_value(hint_map)):
+    frequencies[token['text']] = frequencies.get(token['text'], 0) + term_frequency(token)
+  return frequencies
+
+def describe_mismatch(doc_id, repeated, termfreq):
+  differences = [u'%s: %s vs %s' % (term, repeated.get(term), termfreq.get(term))\
+      for term in sorted(set(repeated) | set(termfreq)) if repeated.get(term) != termfreq.get(term)]
+  return u'%s: %s' % (doc_id, u', '.join(differences[:5]) + (u', ...' if len(differences) > 5 else u''))
+
+def main():
+  num_checked = 0
+  mismatches = []
+  repeat_bytes = 0
+  termfreq_bytes = 0
+
+  for db_url in db_urls:
+    num_db_docs = 0
+    for row in couchdb_rows.iter_rows(db_url + '/_all_docs', params={'include_docs' : 'true'}, page_size=min(num_docs, 1000)):
+      if num_db_docs == num_docs:
+        break
+      hint_map = row['doc'].get('hintMap')
+      if not hint_map:
+        continue
+
+      repeated = repeat_frequencies(hint_map)
+      termfreq = termfreq_frequencies(hint_map)
+      if repeated != termfreq:
+        mismatches.append(describe_mismatch(row['id'], repeated, termfreq))
+      repeat_bytes += len(json.dumps(hint_weighting.repeated_hints(hint_map)))
+      termfreq_bytes += len(json.dumps(hint_weighting.term_frequency_value(hint_map)))
+      num_db_docs += 1
+
+    print "checked %d docs from %s" % (num_db_docs, db_url)
+    num_checked += num_db_docs
+
+  print "hints are %d bytes of JSON with repeat, %d with termfreq (%.1f%%)" %\
+      (repeat_bytes, termfreq_bytes, termfreq_bytes * 100.0 / max(repeat_bytes, 1))
+  if len(mismatches) > 0:
+    for mismatch in mismatches[:MAX_MISMATCHES_SHOWN]:
+      print "MISMATCH", mismatch.encode('utf-8')
+    sys.exit("%d of %d docs have different term frequencies" % (len(mismatches), num_checked))
+  print "all %d docs have the same term frequencies either way" % num_checked
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,31 @@
+#
+# append-only journal of the batches a long-running job has finished, so that a restarted job can skip them
+#
+
+import os
+
+class CheckpointJournal(object):
+
+  def __init__(self, filename, resume):
+    self.filename = filename
+    self.done = set()
+    if resume and os.path.exists(filename):
+      with open(filename, 'rb') as f:
+        self.done = set([line.strip() for line in f if line.strip()])
+    self.file = open(filename, 'ab' if resume else 'wb')
+
+  def __len__(self):
+    return len(self.done)
+
+  def is_done(self, key):
+    return str(key) in self.done
+
+  def mark_done(self, key):
+    # only returns once the entry has hit the disk
+    self.file.write(str(key) + '\n')
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.done.add(str(key))
+
+  def close(self):
+    self.file.close()
@@ -3,95 +3,194 @@
 # create a new block hints, that actually allows us to sort properly and limit the number of hints
 # we get back, in cases where there are just too many damn hints
 #
+# ./compute_mini_block_hints.py [--mode serial/pipelined] [--partitions N] [--readers N] [--writers N]
+#     [--metrics FILE]
+#     [--profile FILE] [--profile-mode sample/timing]
+#
+# in pipelined mode block_hints is split into --partitions key ranges of about the same number of docs,
+# --readers of which are read at a time.  The expanded docs go through a bounded queue to --writers
+# greenlets posting through bulk_writer.py, so the readers wait whenever the output db falls behind.
+#
+# --metrics FILE periodically writes the docs/s, the depth of that queue and the request stats to FILE
+# (see metrics.py); a full queue means the writers are the bottleneck, an empty one the readers.
+#
+# --profile FILE profiles create_new_docs and the posting into FILE (see profiling.py)
+#
 
-import requests, json, sys, itertools
+import json, sys, itertools, getopt
+import hint_ranking, couchdb_client, couchdb_rows, bulk_writer, progress, metrics, profiling, pipeline_config
 import gevent.monkey
 gevent.monkey.patch_socket()
 from gevent.pool import Pool
+from gevent.queue import Queue
+import gevent
 
-INPUT_DB = 'http://localhost:5984/block_hints'
-OUTPUT_DB = 'http://localhost:5984/mini_block_hints'
+INPUT_DB = pipeline_config.couchdb_url('block_hints')
+OUTPUT_DB = pipeline_config.couchdb_url('mini_block_hints')
 
 POOL_SIZE = 1
-ROUGH_BATCH_SIZE = 1000
+ROUGH_BATCH_SIZE = 1000 # input docs per batch of work; bulk_writer.py decides the actual post sizes
 NUM_RETRIES = 10
+QUEUE_SIZE_PER_WRITER = 2 # batches of expanded docs waiting for each writer
+PREFIX_DIGITS = '0123456789'
+PREFIX_RANGES_PER_PARTITION = 4 # how finely key_ranges splits the ids before picking the boundaries
+MAX_PREFIX_LENGTH = 10
+
+args = {'--mode' : 'serial', '--partitions' : '16', '--readers' : '4', '--writers' : '8', '--metrics' : None,\
+    '--profile' : None, '--profile-mode' : 'sample'}
+args.update(dict(getopt.getopt(sys.argv[1:], '', ['mode=', 'partitions=', 'readers=', 'writers=', 'metrics=', 'profile=',\
+    'profile-mode='])[0]))
+
+mode = args['--mode']
+num_partitions = int(args['--partitions'])
+num_readers = int(args['--readers'])
+num_writers = int(args['--writers']) if mode == 'pipelined' else POOL_SIZE
 
-def create_new_docs(input_doc, progress_indicator):
+metrics.start(args['--metrics'])
+profiling.start(args['--profile'], args['--profile-mode'])
+
+couchdb_client.configure(num_readers + num_writers if mode == 'pipelined' else POOL_SIZE, num_retries=NUM_RETRIES)
+
+def create_new_docs(input_doc, progress_counter):
   result = []
   # sort by counts descending, ,hints ascending
-  max_value = 0
-  countsToHints = {}
-  for (hint, count) in input_doc['hintMap'].items():
-    max_value += 1
-    try:
-      countsToHints[count].append(hint)
-    except KeyError:
-      countsToHints[count] = [hint]
-  
-  sortedCounts = sorted(countsToHints.keys())
-  sortedCounts.reverse()
+  ranked_hints = hint_ranking.rank_hints(input_doc['hintMap'], tie_break=hint_ranking.ASCENDING)
   
-  counter = 0
-  max_num_digits = len(str(max_value))
+  max_num_digits = len(str(len(ranked_hints)))
   
-  for count in sortedCounts:
-    hints = countsToHints[count];
-    hints.sort();
-    for hint in hints:
-      docId = input_doc['_id'] + '-' + (str(counter).zfill(max_num_digits))
-      result.append({'_id' : docId, 'hint' : hint, 'count' : count});
-      counter += 1;
+  for (counter, (hint, count)) in enumerate(ranked_hints):
+    docId = input_doc['_id'] + '-' + (str(counter).zfill(max_num_digits))
+    result.append({'_id' : docId, 'hint' : hint, 'count' : count});
   
-  progress_indicator['progress'] += 1
-  sys.stdout.write(' > %.6f%%\r' % (progress_indicator['progress'] * 100.0 / progress_indicator['total']))
-  sys.stdout.flush()
-  if progress_indicator['progress'] == progress_indicator['total']:
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+  progress_counter.add()
   return result
 
 def post_docs(docs):
-  for i in range(NUM_RETRIES):
-    try:
-      print "About to post %d docs to %s" % (len(docs), OUTPUT_DB)
-      response = requests.post(OUTPUT_DB + '/_bulk_docs',data=json.dumps({'docs' : docs}),headers={'Content-Type':'application/json'})
-      
-      print "posted %d docs, response was %d" % (len(docs), response.status_code)
-      if str(response.status_code).startswith('4'):
-        sys.exit("got an error " + response.json())
-      break
-    except requests.exceptions.ConnectionError:
-      print "Connection error at %s, retrying for %dth time" % (OUTPUT_DB, i)
+  print "About to post %d docs to %s" % (len(docs), OUTPUT_DB)
+  try:
+    bulk_writer.get_writer(OUTPUT_DB, num_writers).write(docs)
+  except bulk_writer.BulkWriteError, e:
+    sys.exit("got an error " + str(e))
+  
+  print "posted %d docs" % len(docs)
 
 
 
 def transfer_docs():
-  rows = requests.get(INPUT_DB + '/_all_docs', params={'include_docs' : 'true'}).json()['rows']
-  
-  progress_indicator = {'progress' : 0, 'total' : len(rows)}
+  header = {}
+  progress_counter = progress.ProgressCounter('input docs')
   def process_batch(batch):
     
     docs_to_post = []
     for row in batch:
-      docs_to_post += create_new_docs(row['doc'], progress_indicator)
+      docs_to_post += create_new_docs(row['doc'], progress_counter)
     
     post_docs(docs_to_post)
   
+  # the input docs are streamed in; spawn() blocks while the pool is busy, so only a few batches are
+  # ever in memory
   pool = Pool(POOL_SIZE)
-  for i in range(0, len(rows), ROUGH_BATCH_SIZE):
-    limit = min(len(rows), i + ROUGH_BATCH_SIZE)
-    pool.spawn(process_batch, rows[i:limit])
+  batch = []
+  for row in couchdb_rows.iter_rows(INPUT_DB + '/_all_docs', params={'include_docs' : 'true'}, header=header):
+    progress_counter.total = header.get('total_rows', 0) # not known yet if the server sends it after the rows
+    batch.append(row)
+    if len(batch) == ROUGH_BATCH_SIZE:
+      pool.spawn(process_batch, batch)
+      batch = []
+  if len(batch) > 0:
+    pool.spawn(process_batch, batch)
     
   pool.join()
+  progress_counter.finish()
+
+def key_offset(key):
+  # the number of doc ids before key, which CouchDB counts from its b-tree rather than by walking the rows
+  params = {'startkey' : json.dumps(key), 'limit' : 0}
+  return couchdb_client.get(INPUT_DB + '/_all_docs', params=params).json()['offset']
+
+def key_ranges(num_partitions, doc_count):
+  # (startkey, endkey) pairs covering every doc id, where None means unbounded.  The ids are the int ids
+  # of compute_optimized_couchdb.py (e.g. "1036" and "1036~05"), sorted as strings, so the candidate
+  # boundaries are digit prefixes: one digit to start with, and another digit added to any prefix whose
+  # range holds more than a fraction of a partition, until none do.  The boundaries are then the prefixes
+  # closest to every doc_count/num_partitions docs.
+  max_range_size = max(1, doc_count / (num_partitions * PREFIX_RANGES_PER_PARTITION))
+  offsets = {}
+  prefixes = list(PREFIX_DIGITS)
+  while len(prefixes) > 0:
+    for prefix in prefixes:
+      offsets[prefix] = key_offset(prefix)
+    candidates = sorted(offsets)
+    ends = [offsets[candidate] for candidate in candidates[1:]] + [doc_count]
+    prefixes = [candidate + digit for (candidate, end) in zip(candidates, ends)\
+        if end - offsets[candidate] > max_range_size and len(candidate) < MAX_PREFIX_LENGTH\
+        and candidate + PREFIX_DIGITS[0] not in offsets for digit in PREFIX_DIGITS]
+
+  boundaries = []
+  for i in range(1, num_partitions):
+    target = i * doc_count / num_partitions
+    boundary = min(candidates, key=lambda candidate : abs(offsets[candidate] - target))
+    if offsets[boundary] > (offsets[boundaries[-1]] if len(boundaries) > 0 else 0):
+      boundaries.append(boundary)
+  return zip([None] + boundaries, boundaries + [None])
+
+def read_partition(startkey, endkey, queue, progress_counter):
+  params = {'include_docs' : 'true'}
+  if startkey is not None:
+    params['startkey'] = json.dumps(startkey)
+  if endkey is not None:
+    params.update({'endkey' : json.dumps(endkey), 'inclusive_end' : 'false'})
+  
+  num_input_docs = 0
+  docs_to_post = []
+  for row in couchdb_rows.iter_rows(INPUT_DB + '/_all_docs', params=params, page_size=ROUGH_BATCH_SIZE):
+    if row['id'].startswith('_design/'):
+      continue
+    docs_to_post += create_new_docs(row['doc'], progress_counter)
+    num_input_docs += 1
+    if num_input_docs == ROUGH_BATCH_SIZE:
+      queue.put(docs_to_post) # blocks while the writers are behind
+      num_input_docs = 0
+      docs_to_post = []
+  
+  if len(docs_to_post) > 0:
+    queue.put(docs_to_post)
+
+def write_docs(queue):
+  for docs in queue:
+    post_docs(docs)
+
+def transfer_docs_pipelined():
+  doc_count = couchdb_client.get(INPUT_DB).json()['doc_count']
+  progress_counter = progress.ProgressCounter('input docs', doc_count)
+  queue = Queue(num_writers * QUEUE_SIZE_PER_WRITER)
+  metrics.gauge_function('queue_depth', queue.qsize, queue='expanded docs')
+  
+  writers = [gevent.spawn(write_docs, queue) for i in range(num_writers)]
+  
+  readers = Pool(num_readers)
+  for (startkey, endkey) in key_ranges(num_partitions, doc_count):
+    readers.spawn(read_partition, startkey, endkey, queue, progress_counter)
+  readers.join()
+  
+  for writer in writers:
+    queue.put(StopIteration)
+  gevent.joinall(writers)
+  progress_counter.finish()
 
 def main():
   
   # drop and re-create output database
   
-  print 'dropping database %s, response is %s' % (OUTPUT_DB, requests.delete(OUTPUT_DB).status_code)
-  print 'creating database %s, response is %s' % (OUTPUT_DB, requests.put(OUTPUT_DB).status_code)
+  print 'dropping database %s, response is %s' % (OUTPUT_DB, couchdb_client.delete(OUTPUT_DB).status_code)
+  print 'creating database %s, response is %s' % (OUTPUT_DB, couchdb_client.put(OUTPUT_DB).status_code)
   
-  transfer_docs();
+  if mode == 'pipelined':
+    transfer_docs_pipelined()
+  else:
+    transfer_docs();
+
+profiling.wrap(globals(), ['create_new_docs', 'post_docs'])
 
 if __name__=='__main__':
   main()
\ No newline at end of file
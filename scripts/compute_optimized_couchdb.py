@@ -6,37 +6,91 @@
 # What are the most popular blocks?
 # Given a block, what are the next/previous blocks and their associated hints?
 # 
+# ./compute_optimized_couchdb.py --routing [roundrobin/hash] --engine [couchdb/offline] [--sorted-input FILE]
+#     [--block-ids-index FILE] [--checkpoint FILE] [--resume] [--cpu-workers N] [--fetch perblock/batched]
+#     [--metrics FILE]
+#     [--profile FILE] [--profile-mode sample/timing]
+#
+# use --routing hash if the input was written with compute_couchdb_from_csv.py --routing hash; each
+# block's hints are then fetched from the one shard that owns it, instead of from every shard
+#
+# with --engine offline, the blocks' hints are read in one sequential pass from the FILE written by
+# compute_couchdb_from_csv.py --aggregate external --sorted-output FILE, instead of querying the
+# blocks_to_hints view once per block
+#
+# with --fetch batched, the hints of a whole batch of blocks are fetched with one multi-query request
+# (POST .../_view/blocks_to_hints/queries, CouchDB 2.2 and up) per shard, instead of one request per
+# block per shard
+#
+# with --block-ids-index FILE, block ids are looked up in the index written by compute_block_ids_db.py
+# instead of reading the whole block_ids db into memory first
+#
+# every batch of blocks whose docs were all posted successfully is recorded in the --checkpoint journal.
+# with --resume, the output dbs are not dropped, and batches already in the journal are skipped
+#
+# with --cpu-workers N, splitting docs into summaries/details/hints runs in a pool of N processes, while
+# fetching and posting stay on the gevent greenlets, so that network and CPU work overlap
+#
+# with --metrics FILE, request, throughput and pool metrics are written to FILE periodically (see metrics.py)
+#
+# with --profile FILE, fetching hints (get_block_hints_rows), building block docs, splitting them
+# (split_doc_into_summary_and_details) and posting them are profiled into FILE (see profiling.py)
+#
 
-import requests, json, sys, re, itertools, random
+import json, sys, re, itertools, random, getopt, multiprocessing
+import shard_routing, external_merge, block_ids_index, checkpoint, hint_ranking, couchdb_client, couchdb_rows, bulk_writer,\
+    progress, metrics, profiling, pipeline_config
 import gevent.monkey
 gevent.monkey.patch_socket()
 from gevent.pool import Pool
+from gevent.lock import BoundedSemaphore
+import gevent
 
 MAX_NUM_HINTS_IN_SUMMARY = 30
+SUMMARY_HINT_TIE_BREAK = hint_ranking.DESCENDING # hints with equal counts were always kept in reverse order
 
-COUCHDB_BULK_INSERT_SIZE = 100
+COUCHDB_BULK_INSERT_SIZE = 100 # blocks per batch of work; bulk_writer.py decides the actual post sizes
 COUCHDB_READ_SIZE = 50000
 COUCHDB_RELATED_READ_SIZE = 1000
-RELATED_BLOCKS_BULK_INSERT_SIZE = 10000
 
 POOL_SIZE = 50
 NUM_RETRIES = 10
 
+couchdb_client.configure(POOL_SIZE, num_retries=NUM_RETRIES)
+
 # if true, sets stale to update_after
 DEBUG_MODE = False
 
-INPUT_COUCHDBS = ['http://localhost:5984/blocks_sharded',\
+INPUT_COUCHDBS = pipeline_config.shard_urls(['http://localhost:5984/blocks_sharded',\
     'http://localhost:5985/blocks_sharded',\
     'http://localhost:5986/blocks_sharded',\
     'http://localhost:5987/blocks_sharded',\
     'http://localhost:5988/blocks_sharded',\
-]
+])
+
+args = {'--routing' : 'roundrobin', '--engine' : 'couchdb', '--sorted-input' : 'block_hints.sorted', '--block-ids-index' : None,\
+    '--checkpoint' : 'compute_optimized_couchdb.checkpoint', '--cpu-workers' : '0', '--fetch' : 'perblock', '--metrics' : None,\
+    '--profile' : None, '--profile-mode' : 'sample'}
+args.update(dict(getopt.getopt(sys.argv[1:], '', ['routing=', 'engine=', 'sorted-input=', 'block-ids-index=', 'checkpoint=', 'resume',\
+    'cpu-workers=', 'fetch=', 'metrics=', 'profile=', 'profile-mode='])[0]))
+
+routing = args['--routing']
+engine = args['--engine']
+sorted_input = args['--sorted-input']
+block_ids_index_file = args['--block-ids-index']
+checkpoint_file = args['--checkpoint']
+resume = '--resume' in args
+num_cpu_workers = int(args['--cpu-workers'])
+fetch = args['--fetch']
+metrics_file = args['--metrics']
 
-INPUT_BLOCK_IDS_DB = 'http://localhost:5984/block_ids'
+profiling.start(args['--profile'], args['--profile-mode'])
 
-OUTPUT_URL = 'http://localhost:5984/block_summaries3'
-OUTPUT_DETAILS_URL = 'http://localhost:5984/related_blocks3'
-OUTPUT_HINTS_URL = 'http://localhost:5984/block_hints3'
+INPUT_BLOCK_IDS_DB = pipeline_config.couchdb_url('block_ids')
+
+OUTPUT_URL = pipeline_config.couchdb_url('block_summaries3')
+OUTPUT_DETAILS_URL = pipeline_config.couchdb_url('related_blocks3')
+OUTPUT_HINTS_URL = pipeline_config.couchdb_url('block_hints3')
 
 design_documents = [
 {
@@ -60,7 +114,20 @@ design_documents_hints = [
 blocks_to_ids = {
   }
 
+# set when reading block ids from an on-disk index rather than into blocks_to_ids
+block_ids = None
+
+# batches that have already been posted, see checkpoint.py
+journal = None
+
+# process pool for split_doc_into_summary_and_details(), and a limit on how many batches may be queued up for it
+cpu_pool = None
+cpu_slots = None
+
 def lookup_int_id(block):
+  if block_ids is not None:
+    int_id = block_ids.lookup(block)
+    return None if int_id is None else str(int_id)
   try:
     return str(blocks_to_ids[block])
   except KeyError:
@@ -71,7 +138,8 @@ def convert_to_key_hint_pairs(rows):
   # Python spends less time garbage collecting
   return map(lambda row : (row['key'],row['doc']['hints']), rows)
 
-def get_block_hints_rows((input_url, block)):
+def get_block_hints_rows((input_url, block), after_row=None):
+  # after_row, if given, is a row of the block already fetched elsewhere, which the paging carries on after
   rows = []
   
   block_hints_url = input_url + '/_design/blocks_to_hints/_view/blocks_to_hints'
@@ -86,30 +154,82 @@ def get_block_hints_rows((input_url, block)):
 
   if (DEBUG_MODE):
     params['stale'] = 'update_after'
+  if after_row is not None:
+    params.update(couchdb_rows.next_page_params(after_row))
         
   while True:
-    for i in range(NUM_RETRIES):
-      try:
-        print "getting block hints from %s, %s..." % (block_hints_url, params)
-        current_rows = requests.get(block_hints_url, params=params).json()['rows']
-        print "got block hints"
-        break
-      except requests.exceptions.ConnectionError:
-        print "Connection error at %s, %s, retrying for %dth time" % (block_hints_url, params, i)
+    print "getting block hints from %s, %s..." % (block_hints_url, params)
+    current_rows = couchdb_client.get(block_hints_url, params=params).json()['rows']
+    print "got block hints"
 
     if len(current_rows) == (COUCHDB_RELATED_READ_SIZE + 1):
       # fetched one too many, so keep paging
       rows += convert_to_key_hint_pairs(current_rows[:-1])
-      params['startkey'] = json.dumps(current_rows[-1]['key'],separators=(',',':'))
+      params.update(couchdb_rows.next_page_params(current_rows[-2]))
     else:
       rows += convert_to_key_hint_pairs(current_rows)
       break
   
   return rows
 
-def create_block_document(block, int_id, progress_indicator):
+def get_block_hints_rows_batched(input_url, blocks):
+  # returns a dict of block -> rows for all of the blocks, from one multi-query request.  The results
+  # come back in the same order as the queries, one per block.
+  queries = []
+  for block in blocks:
+    query = {'include_docs' : True, 'startkey' : [[block]], 'endkey' : [[block, {}]], 'limit' : COUCHDB_RELATED_READ_SIZE + 1}
+    if (DEBUG_MODE):
+      query['stale'] = 'update_after'
+    queries.append(query)
+  
+  queries_url = input_url + '/_design/blocks_to_hints/_view/blocks_to_hints/queries'
+  print "getting block hints for %d blocks from %s..." % (len(blocks), queries_url)
+  results = couchdb_client.post(queries_url, data=json.dumps({'queries' : queries},separators=(',',':')),\
+      headers={'Content-Type':'application/json'}).json()['results']
+  print "got block hints"
+  
+  rows_by_block = {}
+  for (block, result) in zip(blocks, results):
+    if len(result['rows']) == (COUCHDB_RELATED_READ_SIZE + 1):
+      # too many to fit in one query, so page through the rest of this block on its own
+      rows_by_block[block] = convert_to_key_hint_pairs(result['rows'][:-1]) +\
+          get_block_hints_rows((input_url, block), result['rows'][-2])
+    else:
+      rows_by_block[block] = convert_to_key_hint_pairs(result['rows'])
+  return rows_by_block
+
+def create_block_documents_batched(batch, progress_counter):
+  # batch is a list of (block, int id) pairs; returns their docs, in the same order
+  blocks = [block for (block, int_id) in batch]
+  
+  if routing == 'hash':
+    blocks_by_url = {}
+    for block in blocks:
+      blocks_by_url.setdefault(shard_routing.shard_for_block(block, INPUT_COUCHDBS), []).append(block)
+  else:
+    blocks_by_url = dict((url, blocks) for url in INPUT_COUCHDBS)
   
-  urls_and_the_block = zip(INPUT_COUCHDBS, [block for i in range(len(INPUT_COUCHDBS))])
+  rows_by_block = dict((block, []) for block in blocks)
+  
+  def getEm(url, url_blocks):
+    for (block, rows) in get_block_hints_rows_batched(url, url_blocks).items():
+      rows_by_block[block] += rows
+  
+  pool = Pool(len(blocks_by_url))
+  for (url, url_blocks) in blocks_by_url.items():
+    pool.spawn(getEm, url, url_blocks)
+  pool.join()
+  
+  return [build_block_document(str(int_id), rows_by_block[block], progress_counter) for (block, int_id) in batch]
+
+def create_block_document(block, int_id, progress_counter):
+  
+  if routing == 'hash':
+    input_urls = [shard_routing.shard_for_block(block, INPUT_COUCHDBS)]
+  else:
+    input_urls = INPUT_COUCHDBS
+  
+  urls_and_the_block = zip(input_urls, [block for i in range(len(input_urls))])
   
   # hit each couchdb roughly equally
   random.shuffle(urls_and_the_block)
@@ -119,13 +239,15 @@ def create_block_document(block, int_id, progress_indicator):
   def getEm(url_and_the_block):
     async_result['rows'] += get_block_hints_rows(url_and_the_block)
   
-  pool = Pool(len(INPUT_COUCHDBS))
+  pool = Pool(len(input_urls))
   for url_and_the_block in urls_and_the_block:
     pool.spawn(getEm, url_and_the_block)
   pool.join()
   
-  all_block_hint_rows = async_result['rows']
-  
+  return build_block_document(int_id, async_result['rows'], progress_counter)
+
+def build_block_document(int_id, all_block_hint_rows, progress_counter):
+  # the rows are (key, hints) pairs, keyed like the blocks_to_hints view
   result = {'_id' : int_id, 'hints' : [], 'precedingBlocks' : {}, 'followingBlocks' : {}}
   
   for (key, hints) in all_block_hint_rows:
@@ -147,13 +269,7 @@ def create_block_document(block, int_id, progress_indicator):
     else: # no related block; singleton only
       result['hints'] += hints
   
-  progress_indicator['progress'] += 1
-  sys.stdout.write(' > %.6f%%\r' % (progress_indicator['progress'] * 100.0 / progress_indicator['total']))
-  sys.stdout.flush()
-  if progress_indicator['progress'] == progress_indicator['total']:
-    sys.stdout.write('\n')
-    sys.stdout.flush()
-    
+  progress_counter.add()
   return result
   
   
@@ -166,20 +282,15 @@ def create_hint_map(hints):
       result[hint] = 1
   return result
 
-def reverse_keys_and_values((k,v)):
-  return (v,k)
-
 def add_doc_hints_if_necessary(doc, doc_hints):
   # put the hints in a separate db, because they take up too much room
   # also, model the hints as a map of strings to ints rather than a list
   hint_map = create_hint_map(doc['hints'])
-  if (len(hint_map.keys()) > MAX_NUM_HINTS_IN_SUMMARY):
-    sorted_hint_map = sorted(map(reverse_keys_and_values, hint_map.items()));
-    sorted_hint_map.reverse()
-    top_hints = dict(map(reverse_keys_and_values, sorted_hint_map[:MAX_NUM_HINTS_IN_SUMMARY]))
-    doc['hintMap'] = top_hints
-    doc['hintsRedacted'] = sum(map(lambda x:x[0],sorted_hint_map[MAX_NUM_HINTS_IN_SUMMARY:]))
-    doc['hintsRedactedUnique'] = (len(hint_map.keys()) - MAX_NUM_HINTS_IN_SUMMARY)
+  if (len(hint_map) > MAX_NUM_HINTS_IN_SUMMARY):
+    top_hints = hint_ranking.rank_hints(hint_map, MAX_NUM_HINTS_IN_SUMMARY, SUMMARY_HINT_TIE_BREAK)
+    doc['hintMap'] = dict(top_hints)
+    doc['hintsRedacted'] = len(doc['hints']) - sum(map(lambda x:x[1],top_hints))
+    doc['hintsRedactedUnique'] = (len(hint_map) - MAX_NUM_HINTS_IN_SUMMARY)
     doc_hints.append({'_id' : doc['_id'], 'hintMap' : hint_map})
   else:
     doc['hintMap'] = hint_map
@@ -231,27 +342,29 @@ def split_doc_into_summary_and_details(doc):
   return (doc, related_blocks, doc_hints)
 
 def post_bulk(url, docs):
-  
-  for j in range(0, len(docs), RELATED_BLOCKS_BULK_INSERT_SIZE):
-    
-    limit = min(len(docs), j + RELATED_BLOCKS_BULK_INSERT_SIZE)
-    subdocs = docs[j:limit]
-    
-    for i in range(NUM_RETRIES):
-      try:
-        print "About to post %d docs to %s" % (len(subdocs), url)
-        response = requests.post(url + '/_bulk_docs',data=json.dumps({'docs' : subdocs}),headers={'Content-Type':'application/json'})
-        break
-      except requests.exceptions.ConnectionError:
-        print "Connection error at %s, %s, retrying for %dth time" % (block_hints_url, params, i)
+  # returns True if every doc was accepted
+  print "About to post %d docs to %s" % (len(docs), url)
+  try:
+    bulk_writer.get_writer(url, POOL_SIZE).write(docs)
+  except bulk_writer.BulkWriteError, e:
+    print " > > Got error", e
+    return False
+  
+  print " > Posted %d documents to %s" % (len(docs), url)
+  return True
+  
+def split_docs(docs):
+  if cpu_pool is None:
+    return map(split_doc_into_summary_and_details, docs)
+  
+  # wait for the process pool from a real thread, so that the hub keeps running the other greenlets' I/O
+  with cpu_slots:
+    async_result = cpu_pool.map_async(split_doc_into_summary_and_details, docs)
+    return gevent.get_hub().threadpool.apply(async_result.get)
 
-    print " > Posted %d documents to %s, response: %d" % (len(subdocs), url, response.status_code)
-    if (str(response.status_code).startswith('4')): # error
-      print " > > Got error", response.json()
-  
 def post_documents_to_couchdb(docs):
   
-  summaries_and_details = map(split_doc_into_summary_and_details, docs);
+  summaries_and_details = split_docs(docs)
   
   summary_docs = map(lambda x : x[0], summaries_and_details)
   details_docs = map(lambda x : x[1], summaries_and_details)
@@ -262,86 +375,179 @@ def post_documents_to_couchdb(docs):
   
   print "Posting %d docs..." % len(summary_docs);
   
-  post_bulk(OUTPUT_URL, summary_docs)
-  post_bulk(OUTPUT_DETAILS_URL, details_docs)
-  post_bulk(OUTPUT_HINTS_URL, hints_docs)
+  # post to every db even if one of them fails, so that a resumed run has less to redo
+  results = [post_bulk(OUTPUT_URL, summary_docs), post_bulk(OUTPUT_DETAILS_URL, details_docs), post_bulk(OUTPUT_HINTS_URL, hints_docs)]
+  return all(results)
+
+def skip_batch(batch_key, batch_size, progress_counter):
+  # true if the journal says this batch was posted by an earlier run
+  if not journal.is_done(batch_key):
+    return False
+  progress_counter.add(batch_size)
+  return True
+
+def post_and_checkpoint(batch_key, docs):
+  if post_documents_to_couchdb(docs):
+    journal.mark_done(batch_key)
+  else:
+    print " > batch %s was not fully posted; it will be retried with --resume" % batch_key
   
 def create_block_documents():
   
-  
-  blocks_and_ids = blocks_to_ids.items()  
+  # the index supports len() and slicing just like the list of items
+  # (sorted, so that the batches come out the same in a resumed run)
+  blocks_and_ids = block_ids if block_ids is not None else sorted(blocks_to_ids.items())
   pool = Pool(POOL_SIZE)
-  progress_indicator = {'progress' : 0, 'total' : len(blocks_and_ids)}
+  metrics.gauge_function('pool_greenlets', pool.__len__, pool='blocks')
+  progress_counter = progress.ProgressCounter('blocks', len(blocks_and_ids))
 
   for i in range(0, len(blocks_and_ids), COUCHDB_BULK_INSERT_SIZE * POOL_SIZE):
     
     limit = min(len(blocks_and_ids), i + (COUCHDB_BULK_INSERT_SIZE * POOL_SIZE))
     batches_as_list = blocks_and_ids[i:limit]
     
-    # partition into roughly equal sublists
+    # partition into roughly equal sublists, keyed by their offset in blocks_and_ids
     async_batches = []
     for j in range(0, len(batches_as_list), COUCHDB_BULK_INSERT_SIZE):
       if j >= len(batches_as_list):
         break
       limit = min(len(batches_as_list), j + COUCHDB_BULK_INSERT_SIZE)
-      async_batches.append(batches_as_list[j:limit])
+      async_batches.append(('blocks-%d' % (i + j), batches_as_list[j:limit]))
     
-    def process_and_post(batch):  
-      docs_batch = map((lambda x : create_block_document(x[0], str(x[1]), progress_indicator)), batch)
-      post_documents_to_couchdb(docs_batch)
+    def process_and_post(batch_key, batch):  
+      if fetch == 'batched':
+        docs_batch = create_block_documents_batched(batch, progress_counter)
+      else:
+        docs_batch = map((lambda x : create_block_document(x[0], str(x[1]), progress_counter)), batch)
+      post_and_checkpoint(batch_key, docs_batch)
     
-    for async_batch in async_batches:
-      pool.spawn(process_and_post, async_batch)
+    for (batch_key, async_batch) in async_batches:
+      if not skip_batch(batch_key, len(async_batch), progress_counter):
+        pool.spawn(process_and_post, batch_key, async_batch)
+    
+  pool.join()
+  progress_counter.finish()
+
+def read_sorted_block_hints_rows(filename):
+  # yields (block, rows) for every block in the file, with the rows in the same shape get_block_hints_rows() returns
+  def rows():
+    for (key, value) in external_merge.read_run(filename):
+      (reverse, hints) = json.loads(value)
+      yield ([key.split(' '), reverse], hints)
+  
+  for (block, block_rows) in itertools.groupby(rows(), key=lambda row : row[0][0][0]):
+    yield (block, list(block_rows))
+
+def create_block_documents_offline():
+  pool = Pool(POOL_SIZE)
+  metrics.gauge_function('pool_greenlets', pool.__len__, pool='posts')
+  progress_counter = progress.ProgressCounter('blocks', len(block_ids if block_ids is not None else blocks_to_ids))
+  batch = []
+  batch_idx = 0
+  
+  def finish_batch(batch_key, batch):
+    # batches are keyed by their position in the file, which is the same on every run
+    if not skip_batch(batch_key, len(batch), progress_counter):
+      docs_batch = [build_block_document(int_id, rows, progress_counter) for (int_id, rows) in batch]
+      pool.spawn(post_and_checkpoint, batch_key, docs_batch)
+  
+  # one sequential pass over the file; only the posting happens concurrently
+  for (block, rows) in read_sorted_block_hints_rows(sorted_input):
+    int_id = lookup_int_id(block)
+    if int_id is None: # block wasn't important enough to have its own id
+      continue
     
+    batch.append((int_id, rows))
+    if len(batch) == COUCHDB_BULK_INSERT_SIZE:
+      finish_batch('sorted-%d' % batch_idx, batch)
+      batch = []
+      batch_idx += 1
+  
+  if len(batch) > 0:
+    finish_batch('sorted-%d' % batch_idx, batch)
   pool.join()
+  progress_counter.finish()
 
 def build_blocks_to_ids_map():
   block_ids_url = INPUT_BLOCK_IDS_DB + '/_all_docs'
-  params = {'limit' : COUCHDB_READ_SIZE, 'include_docs' : 'true'}
+  params = {'include_docs' : 'true'}
   if DEBUG_MODE:
     params['stale'] = 'update_after'
   
+  # rows are parsed as they stream in, so only the map itself has to fit in memory
+  header = {}
   num_read = 0
-  while True:
-    block_ids = requests.get(block_ids_url, params=params).json()
-
-    if len(block_ids['rows']) == 0:
-      break
-    
-    num_read += len(block_ids['rows'])
-    total = block_ids['total_rows']
-    print "Received %d/%d (%.2f%%) docs from CouchDB %s" % (num_read,total,num_read * 100.0/total, INPUT_BLOCK_IDS_DB)
-    
-    for row in block_ids['rows']:
-      if 'intId' in row['doc']: # skip design documents
-        blocks_to_ids[row['key']] = row['doc']['intId']
+  for row in couchdb_rows.iter_rows(block_ids_url, params=params, page_size=COUCHDB_READ_SIZE, header=header):
+    if 'intId' in row['doc']: # skip design documents
+      blocks_to_ids[row['key']] = row['doc']['intId']
     
-    params.update({'startkey' : json.dumps(block_ids['rows'][-1]['key']), 'skip' : 1})
+    num_read += 1
+    if num_read % COUCHDB_READ_SIZE == 0:
+      total = header.get('total_rows') # not known yet if the server sends it after the rows
+      if total:
+        print "Received %d/%d (%.2f%%) docs from CouchDB %s" % (num_read,total,num_read * 100.0/total, INPUT_BLOCK_IDS_DB)
+      else:
+        print "Received %d docs from CouchDB %s" % (num_read, INPUT_BLOCK_IDS_DB)
     
     if DEBUG_MODE and num_read > 10000:
       break
     
   print "read in all docs from db %s" % INPUT_BLOCK_IDS_DB
   
-def main():
+def create_databases():
   
   # drop and re-create both output databases
   for url in (OUTPUT_URL, OUTPUT_DETAILS_URL, OUTPUT_HINTS_URL):
-    print 'dropping database %s, response is %s' % (url, requests.delete(url).status_code)
-    print 'creating database %s, response is %s' % (url, requests.put(url).status_code)
+    print 'dropping database %s, response is %s' % (url, couchdb_client.delete(url).status_code)
+    print 'creating database %s, response is %s' % (url, couchdb_client.put(url).status_code)
   
   for design_doc in design_documents:
-    response = requests.put(OUTPUT_URL + '/' + design_doc['_id'],data=json.dumps(design_doc),headers={'Content-Type':'application/json'})
+    response = couchdb_client.put(OUTPUT_URL + '/' + design_doc['_id'],data=json.dumps(design_doc),headers={'Content-Type':'application/json'})
     print 'posted design doc %s to CouchDB, got response %d' % (design_doc['_id'], response.status_code)
   for design_doc in design_documents_hints:
-    response = requests.put(OUTPUT_HINTS_URL + '/' + design_doc['_id'],data=json.dumps(design_doc),headers={'Content-Type':'application/json'})
+    response = couchdb_client.put(OUTPUT_HINTS_URL + '/' + design_doc['_id'],data=json.dumps(design_doc),headers={'Content-Type':'application/json'})
     print 'posted design doc %s to CouchDB, got response %d' % (design_doc['_id'], response.status_code)
 
+def main():
+  global block_ids, journal, cpu_pool, cpu_slots
+  
+  if num_cpu_workers > 0:
+    # fork before any greenlets exist
+    cpu_pool = multiprocessing.Pool(num_cpu_workers)
+    cpu_slots = BoundedSemaphore(2 * num_cpu_workers)
+    gevent.get_hub().threadpool.maxsize = 2 * num_cpu_workers
+  
+  # only once the workers are forked, so that they don't inherit the snapshot thread's lock
+  metrics.start(metrics_file)
+  
+  journal = checkpoint.CheckpointJournal(checkpoint_file, resume)
+  
+  if resume:
+    print 'resuming, %d batches already done according to %s' % (len(journal), checkpoint_file)
+  else:
+    create_databases()
+
 
-  print "\nreading from input CouchDB %s..." % (INPUT_BLOCK_IDS_DB)
-  build_blocks_to_ids_map()
-  print "\nreading from blocks_to_hints in %s, writing to %s..." % (INPUT_COUCHDBS, (OUTPUT_URL, OUTPUT_DETAILS_URL, OUTPUT_HINTS_URL))
-  create_block_documents()
+  if block_ids_index_file:
+    block_ids = block_ids_index.BlockIdsIndex(block_ids_index_file)
+    print "\nusing %d block ids from %s" % (len(block_ids), block_ids_index_file)
+  else:
+    print "\nreading from input CouchDB %s..." % (INPUT_BLOCK_IDS_DB)
+    build_blocks_to_ids_map()
+  if engine == 'offline':
+    print "\nreading from %s, writing to %s..." % (sorted_input, (OUTPUT_URL, OUTPUT_DETAILS_URL, OUTPUT_HINTS_URL))
+    create_block_documents_offline()
+  else:
+    print "\nreading from blocks_to_hints in %s, writing to %s..." % (INPUT_COUCHDBS, (OUTPUT_URL, OUTPUT_DETAILS_URL, OUTPUT_HINTS_URL))
+    create_block_documents()
   
+  journal.close()
+  if cpu_pool is not None:
+    cpu_pool.close()
+    cpu_pool.join()
+  
+profiling.wrap(globals(), ['create_block_document', 'create_block_documents_batched', 'get_block_hints_rows',\
+    'get_block_hints_rows_batched', 'build_block_document', 'split_docs', 'split_doc_into_summary_and_details', 'post_bulk'])
+
 if __name__=='__main__':
   main()
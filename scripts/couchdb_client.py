@@ -0,0 +1,115 @@
+#
+# pooled, keep-alive HTTP client for talking to CouchDB (and Solr), shared by all of the scripts
+#
+# every host gets one requests.Session whose connection pool is sized to the gevent Pool that uses it,
+# plus a semaphore limiting how many requests can be in flight to that host at once.  Connection errors
+# and 5xx responses are retried with exponential backoff and full jitter, instead of immediately.
+#
+# use it like the requests module: couchdb_client.get(url, params=...), couchdb_client.post(...), etc.
+#
+# every request is recorded in metrics.py under its endpoint (host and path, without the query string):
+# counts by status, bytes both ways, time spent waiting for a slot and waiting for the response, and
+# retries.  The bytes of stream=True responses are counted by whoever reads them (couchdb_rows.py).
+#
+
+import random, time, urlparse
+import requests
+import gevent
+from gevent.lock import BoundedSemaphore
+import metrics
+
+BASE_BACKOFF = 0.1 # seconds
+MAX_BACKOFF = 30.0
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+settings = {'pool_size' : 10, 'max_per_host' : 10, 'num_retries' : 10}
+
+hosts = {}
+
+def configure(pool_size, max_per_host=None, num_retries=None):
+  # call before the first request; pool_size should match the size of the gevent Pool making requests
+  settings['pool_size'] = pool_size
+  settings['max_per_host'] = max_per_host or pool_size
+  if num_retries is not None:
+    settings['num_retries'] = num_retries
+
+class Host(object):
+
+  def __init__(self):
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=settings['pool_size'])
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.slots = BoundedSemaphore(settings['max_per_host'])
+
+def get_host(url):
+  parsed_url = urlparse.urlsplit(url)
+  key = (parsed_url.scheme, parsed_url.netloc)
+  try:
+    return hosts[key]
+  except KeyError:
+    host = hosts[key] = Host()
+    return host
+
+def endpoint_name(url):
+  # the scripts never address docs by id except for design docs, so the paths are few enough to use as is
+  # (leaving out any user:password@ in front of the host)
+  parsed_url = urlparse.urlsplit(url)
+  return parsed_url.netloc.rsplit('@', 1)[-1] + parsed_url.path.rstrip('/')
+
+def body_size(data):
+  if data is None:
+    return 0
+  if isinstance(data, basestring):
+    return len(data)
+  return getattr(data, 'size', 0) # a streamed body that counts itself, like bulk_writer.BatchBody
+
+def record_response(method, endpoint, response, latency, data, stream):
+  metrics.inc('http_requests_total', method=method, endpoint=endpoint, status=response.status_code)
+  metrics.observe('http_request_seconds', latency, endpoint=endpoint)
+  metrics.inc('http_bytes_sent_total', body_size(data), endpoint=endpoint)
+  if not stream:
+    metrics.inc('http_bytes_received_total', len(response.content), endpoint=endpoint)
+
+def backoff(attempt):
+  return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * (2 ** attempt)))
+
+def request(method, url, num_retries=None, retry_status_codes=RETRY_STATUS_CODES, **kwargs):
+  # raises requests.exceptions.ConnectionError once the retries are used up; a response with one of
+  # retry_status_codes is returned as-is once the retries are used up
+  if num_retries is None:
+    num_retries = settings['num_retries']
+  host = get_host(url)
+  endpoint = endpoint_name(url)
+
+  for attempt in range(num_retries + 1):
+    try:
+      wait_start_time = time.time()
+      with host.slots:
+        start_time = time.time()
+        metrics.observe('http_slot_wait_seconds', start_time - wait_start_time, endpoint=endpoint)
+        response = host.session.request(method, url, **kwargs)
+      record_response(method, endpoint, response, time.time() - start_time, kwargs.get('data'), kwargs.get('stream'))
+      if response.status_code not in retry_status_codes or attempt == num_retries:
+        return response
+      metrics.inc('http_retries_total', endpoint=endpoint, reason=response.status_code)
+      print "Got response %d from %s, retrying for %dth time" % (response.status_code, url, attempt + 1)
+    except requests.exceptions.ConnectionError:
+      metrics.inc('http_connection_errors_total', endpoint=endpoint)
+      if attempt == num_retries:
+        raise
+      metrics.inc('http_retries_total', endpoint=endpoint, reason='connection')
+      print "Connection error at %s, retrying for %dth time" % (url, attempt + 1)
+    gevent.sleep(backoff(attempt))
+
+def get(url, **kwargs):
+  return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+  return request('POST', url, **kwargs)
+
+def put(url, **kwargs):
+  return request('PUT', url, **kwargs)
+
+def delete(url, **kwargs):
+  return request('DELETE', url, **kwargs)
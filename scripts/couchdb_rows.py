@@ -0,0 +1,128 @@
+#
+# streams the rows of a CouchDB view or _all_docs response, parsing them one at a time as they come in,
+# instead of loading the whole response with .json()
+#
+# iter_rows() also pages through the view with startkey/skip, so that a whole db can be read in constant
+# memory:
+#
+#   for row in couchdb_rows.iter_rows(url + '/_all_docs', params={'include_docs' : 'true'}):
+#     ...
+#
+
+import json, re
+import requests
+import gevent
+import couchdb_client, metrics
+
+PAGE_SIZE = 10000
+READ_SIZE = 64 * 1024
+ROWS_START = re.compile(r'"rows"\s*:\s*\[')
+WHITESPACE = ' \t\n\r'
+
+decoder = json.JSONDecoder()
+
+class RowReadError(Exception):
+  pass
+
+def counted_chunks(response):
+  # couchdb_client.py can't count the bytes of a streamed response, so they're counted as they're read
+  endpoint = couchdb_client.endpoint_name(response.url)
+  for chunk in response.iter_content(READ_SIZE):
+    metrics.inc('http_bytes_received_total', len(chunk), endpoint=endpoint)
+    yield chunk
+
+def iter_response_rows(response, header=None):
+  # yields the rows of a single (stream=True) response as they arrive; if a header dict is given, it's
+  # filled in with the other fields (total_rows and offset).  CouchDB sends those in front of the rows, but
+  # anything that comes after them is only filled in once the last row has been yielded.
+  chunks = counted_chunks(response)
+
+  buf = ''
+  rows_start = None
+  while rows_start is None:
+    chunk = next(chunks, None)
+    if chunk is None:
+      raise RowReadError('no rows in response from %s: %s' % (response.url, buf[:1000]))
+    buf += chunk
+    rows_start = ROWS_START.search(buf)
+  if header is not None:
+    header.update(json.loads(buf[:rows_start.start()].rstrip(WHITESPACE + ',') + '}'))
+  pos = rows_start.end()
+
+  while True:
+    while pos < len(buf) and buf[pos] in WHITESPACE + ',':
+      pos += 1
+    if pos < len(buf) and buf[pos] == ']': # end of the rows
+      if header is not None:
+        header.update(read_trailer(buf[pos + 1:], chunks, response.url))
+      return
+
+    row = None
+    if pos < len(buf):
+      try:
+        (row, pos) = decoder.raw_decode(buf, pos)
+      except ValueError:
+        pass # the row isn't all here yet
+    if row is not None:
+      yield row
+      continue
+
+    # read more, at least doubling what's buffered, so a huge row doesn't get re-parsed for every chunk
+    buf = buf[pos:]
+    pos = 0
+    wanted = len(buf) + max(READ_SIZE, len(buf))
+    num_buffered = len(buf)
+    for chunk in chunks:
+      buf += chunk
+      if len(buf) >= wanted:
+        break
+    if len(buf) == num_buffered:
+      raise RowReadError('response from %s ended in the middle of the rows' % response.url)
+
+def read_trailer(buf, chunks, url):
+  # the fields after the rows, if any, e.g. '],"total_rows":3,"offset":0}' from behind the ']'
+  buf += ''.join(chunks)
+  try:
+    return json.loads('{' + buf.lstrip(WHITESPACE + ','))
+  except ValueError:
+    raise RowReadError('could not parse the end of the response from %s: %s' % (url, buf[:1000]))
+
+def next_page_params(last_row):
+  params = {'startkey' : json.dumps(last_row['key']), 'skip' : 1}
+  if 'id' in last_row: # in case there's more than one row with the same key
+    params['startkey_docid'] = last_row['id']
+  return params
+
+def iter_rows(url, params=None, page_size=PAGE_SIZE, header=None):
+  # yields every row of the view at url, reading page_size rows per request.  If the connection drops in
+  # the middle of a page, reading resumes after the last row that was yielded.
+  params = dict(params or {})
+  params['limit'] = page_size
+  attempt = 0
+
+  while True:
+    num_rows = 0
+    last_row = None
+    response = couchdb_client.get(url, params=params, stream=True)
+    try:
+      if response.status_code != 200:
+        raise RowReadError('got response %d from %s: %s' % (response.status_code, url, response.text))
+      for row in iter_response_rows(response, header):
+        num_rows += 1
+        last_row = row
+        yield row
+    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+      if attempt == couchdb_client.settings['num_retries']:
+        raise
+      print "Connection error reading %s, resuming for %dth time" % (url, attempt + 1)
+      gevent.sleep(couchdb_client.backoff(attempt))
+      attempt += 1
+      if last_row is not None:
+        params.update(next_page_params(last_row))
+      continue
+    finally:
+      response.close()
+
+    if num_rows < page_size:
+      return
+    params.update(next_page_params(last_row))
@@ -3,9 +3,10 @@
 # Create the user_docs DB in CouchDB, which holds user-specific document (i.e. their guesses for various hints)
 #
 
-import requests, json
+import json
+import couchdb_client, pipeline_config
 
-URL = 'http://localhost:5984/user_docs'
+URL = pipeline_config.couchdb_url('user_docs')
 
 design_documents = [
 {
@@ -79,9 +80,9 @@ design_documents = [
 ]
 
 
-print 'dropping database %s, response is %s' % (URL, requests.delete(URL).status_code)
-print 'creating database %s, response is %s' % (URL, requests.put(URL).status_code)
+print 'dropping database %s, response is %s' % (URL, couchdb_client.delete(URL).status_code)
+print 'creating database %s, response is %s' % (URL, couchdb_client.put(URL).status_code)
 
 for design_doc in design_documents:
-  response = requests.put(URL + '/' + design_doc['_id'],data=json.dumps(design_doc),headers={'Content-Type':'application/json'})
+  response = couchdb_client.put(URL + '/' + design_doc['_id'],data=json.dumps(design_doc),headers={'Content-Type':'application/json'})
   print 'posted design doc %s to CouchDB, got response %d %s' % (design_doc['_id'], response.status_code, response.json())
@@ -0,0 +1,160 @@
+#
+# compact, columnar replacement for cred.csv, holding only what the later stages need: the blocks
+# and the hint of each record
+#
+# layout (all integers little-endian):
+#
+#   header         : magic, record/block/hint counts, then the file offset of every section below
+#   block index    : one uint64 offset per unique block, relative to the start of the block data
+#   block data     : uint32 length + bytes, for each unique block
+#   hint index     : same as the block index, for unique hints
+#   hint data      : same as the block data, for unique hints
+#   records        : three uint32 columns of num_records entries each: first block id,
+#                    second block id (NO_BLOCK for 12-char passwords), hint id
+#
+
+import os, sys, mmap, struct, shutil
+from array import array
+import cred_scanner
+
+MAGIC = 'CREDBIN1'
+HEADER_FORMAT = '<8s3Q7Q'
+NO_BLOCK = 0xFFFFFFFF
+COLUMN_FLUSH_SIZE = 1000000
+READ_BATCH_SIZE = 100000
+
+def to_little_endian(arr):
+  if sys.byteorder == 'big':
+    arr.byteswap()
+  return arr
+
+class StringTableWriter(object):
+  # deduplicated strings, appended to temporary index and data files as they're first seen
+
+  def __init__(self, filename):
+    self.ids = {}
+    self.index_filename = filename + '.index'
+    self.data_filename = filename + '.data'
+    self.index_file = open(self.index_filename, 'wb')
+    self.data_file = open(self.data_filename, 'wb')
+    self.data_len = 0
+
+  def intern(self, s):
+    try:
+      return self.ids[s]
+    except KeyError:
+      string_id = len(self.ids)
+      self.ids[s] = string_id
+      self.index_file.write(struct.pack('<Q', self.data_len))
+      self.data_file.write(struct.pack('<I', len(s)))
+      self.data_file.write(s)
+      self.data_len += 4 + len(s)
+      return string_id
+
+  def close(self):
+    self.index_file.close()
+    self.data_file.close()
+
+class CredBinaryWriter(object):
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.num_records = 0
+    self.blocks = StringTableWriter(filename + '.blocks')
+    self.hints = StringTableWriter(filename + '.hints')
+    self.columns = [array('I') for i in range(3)]
+    self.column_filenames = ['%s.column%d' % (filename, i) for i in range(3)]
+    self.column_files = [open(column_filename, 'wb') for column_filename in self.column_filenames]
+
+  def add(self, password, hint):
+    new_blocks = cred_scanner.password_to_blocks(password)
+    if new_blocks is None:
+      return
+
+    self.columns[0].append(self.blocks.intern(new_blocks[0]))
+    self.columns[1].append(self.blocks.intern(new_blocks[1]) if len(new_blocks) > 1 else NO_BLOCK)
+    self.columns[2].append(self.hints.intern(hint))
+    self.num_records += 1
+
+    if len(self.columns[0]) == COLUMN_FLUSH_SIZE:
+      self.flush_columns()
+
+  def flush_columns(self):
+    for (column, column_file) in zip(self.columns, self.column_files):
+      to_little_endian(column).tofile(column_file)
+      del column[:]
+
+  def close(self):
+    self.flush_columns()
+    for column_file in self.column_files:
+      column_file.close()
+    self.blocks.close()
+    self.hints.close()
+
+    parts = [self.blocks.index_filename, self.blocks.data_filename, self.hints.index_filename,\
+        self.hints.data_filename] + self.column_filenames
+
+    # every section starts right after the previous one
+    offsets = [struct.calcsize(HEADER_FORMAT)]
+    for part in parts[:-1]:
+      offsets.append(offsets[-1] + os.path.getsize(part))
+
+    with open(self.filename, 'wb') as f:
+      f.write(struct.pack(HEADER_FORMAT, MAGIC, self.num_records, len(self.blocks.ids), len(self.hints.ids), *offsets))
+      for part in parts:
+        with open(part, 'rb') as part_file:
+          shutil.copyfileobj(part_file, f)
+        os.remove(part)
+
+class CredBinaryReader(object):
+
+  def __init__(self, filename):
+    self.file = open(filename, 'rb')
+    self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+    if header[0] != MAGIC:
+      raise ValueError('%s is not a binary cred file' % filename)
+
+    (self.num_records, self.num_blocks, self.num_hints) = header[1:4]
+    (self.blocks_index, self.blocks_data, self.hints_index, self.hints_data) = header[4:8]
+    self.columns = header[8:11]
+
+  def __len__(self):
+    return self.num_records
+
+  def get_string(self, index_offset, data_offset, string_id):
+    start = data_offset + struct.unpack_from('<Q', self.mm, index_offset + 8 * string_id)[0]
+    length = struct.unpack_from('<I', self.mm, start)[0]
+    return self.mm[start + 4:start + 4 + length]
+
+  def get_block(self, block_id):
+    return self.get_string(self.blocks_index, self.blocks_data, block_id)
+
+  def get_hint(self, hint_id):
+    return self.get_string(self.hints_index, self.hints_data, hint_id)
+
+  def read_column(self, column_idx, start, end):
+    offset = self.columns[column_idx] + 4 * start
+    column = array('I')
+    column.fromstring(self.mm[offset:offset + 4 * (end - start)])
+    return to_little_endian(column)
+
+  def iter_ids(self):
+    # yields (first block id, second block id or NO_BLOCK, hint id) for every record
+    for start in xrange(0, self.num_records, READ_BATCH_SIZE):
+      end = min(self.num_records, start + READ_BATCH_SIZE)
+      for ids in zip(*[self.read_column(i, start, end) for i in range(3)]):
+        yield ids
+
+  def iter_blocks_and_hints(self):
+    # yields (blocks, hint) for every record, as taken by analyze_blocks_and_hint() in compute_couchdb_from_csv.py
+    for (block1, block2, hint) in self.iter_ids():
+      if block2 == NO_BLOCK:
+        yield ((self.get_block(block1),), self.get_hint(hint))
+      else:
+        yield ((self.get_block(block1), self.get_block(block2)), self.get_hint(hint))
+
+  def close(self):
+    self.mm.close()
+    self.file.close()
@@ -0,0 +1,75 @@
+#
+# scan the raw cred file through an mmap, yielding only the (password, hint) pair of each record
+#
+# Fields are located with mmap.find() on byte offsets, so nothing is copied out of the map until
+# a record's password has passed the 12/24-length filter.  (Python 2's mmap doesn't expose the
+# buffer interface needed for memoryview, so offsets stand in for memoryview slices here.)
+#
+
+import mmap
+
+SEPARATOR = '-|-'
+LINE_TERMINATOR = '|--'
+WHITESPACE = ' \t\n\r\x0b\x0c'
+NUM_FIELDS = 5
+
+def scan_passwords_and_hints(filename, start=0, end=None):
+  with open(filename, 'rb') as f:
+    f.seek(0, 2)
+    if f.tell() == 0: # can't mmap an empty file
+      return
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      for password_and_hint in scan_mmap(mm, start, len(mm) if end is None else end):
+        yield password_and_hint
+    finally:
+      mm.close()
+
+def scan_mmap(mm, start, end):
+  find = mm.find
+  sep_len = len(SEPARATOR)
+  pos = start
+
+  while pos < end:
+    line_start = pos
+    line_end = find('\n', pos, end)
+    if line_end == -1:
+      line_end = end
+    pos = line_end + 1
+
+    # same as parse_line() in load_cred_file.py: strip, then drop the trailing '|--'
+    while line_end > line_start and mm[line_end - 1] in WHITESPACE:
+      line_end -= 1
+    if line_end - line_start >= len(LINE_TERMINATOR) and mm[line_end - len(LINE_TERMINATOR):line_end] == LINE_TERMINATOR:
+      line_end -= len(LINE_TERMINATOR)
+
+    # find the separators in front of each field after the first one
+    separators = []
+    sep = find(SEPARATOR, line_start, line_end)
+    while sep != -1 and len(separators) < NUM_FIELDS:
+      separators.append(sep)
+      sep = find(SEPARATOR, sep + sep_len, line_end)
+
+    if len(separators) != NUM_FIELDS - 1: # empty line, or too many fields
+      continue
+
+    password_start = separators[2] + sep_len
+    password_end = separators[3]
+    password_len = password_end - password_start
+    hint_start = separators[3] + sep_len
+
+    # ignore passwords that can't be divided into blocks, and records without hints
+    if (password_len != 12 and password_len != 24) or hint_start >= line_end:
+      continue
+
+    yield (mm[password_start:password_end], mm[hint_start:line_end])
+
+def password_to_blocks(password):
+  # ignore passwords that are longer; I'm not sure how to divide them into blocks, and there
+  # aren't very many of them, anyway
+  password_len = len(password)
+  if (password_len == 12):
+    return (password[:11],)
+  elif (password_len == 24):
+    return (password[:11], password[11:22])
+  return None
@@ -0,0 +1,25 @@
+#
+# sorted runs spilled to local disk, merged back together so that every key comes out exactly once
+#
+# a run is a text file of "<key>\t<json value>" lines, sorted by key.  json.dumps() never emits a
+# raw tab or newline, so the last tab on a line always separates the key from the value
+#
+
+import json, heapq, itertools
+
+def write_run(filename, items):
+  # items must already be sorted by key
+  with open(filename, 'wb') as f:
+    for (key, value) in items:
+      f.write(key + '\t' + json.dumps(value, separators=(',',':')) + '\n')
+
+def read_run(filename):
+  with open(filename, 'rb') as f:
+    for line in f:
+      yield tuple(line[:-1].rsplit('\t', 1))
+
+def merge_runs(filenames):
+  # yields (key, [value from each run that had the key]) in key order
+  merged = heapq.merge(*[read_run(filename) for filename in filenames])
+  for (key, items) in itertools.groupby(merged, key=lambda item : item[0]):
+    yield (key, [json.loads(value) for (ignored, value) in items])
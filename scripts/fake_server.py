@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+#
+# in-memory stand-in for CouchDB and Solr, for benchmarking the pipeline on one machine
+#
+# ./fake_server.py [--port N] [--latency MS] [--latency-per-kb MS] [--jitter MS] [--error-rate P]
+#     [--max-request-size BYTES]
+#
+# implements just enough of CouchDB for these scripts: creating/dropping dbs, db info, single docs,
+# _bulk_docs (with conflicts), _all_docs, _changes (normal and longpoll), and the views from the
+# design docs the scripts create (blocks_to_hints, blocks_to_counts with _sum, counts_to_blocks),
+# including multi-query POSTs to .../queries.  Anything under /solr is a Solr core that accepts
+# /update/json adds, deletes and commits, and request handler updates through /config.  Point the
+# scripts at it through pipeline_config.py; several "shards" can live on one server as differently
+# named dbs.
+#
+# every response is held back by --latency, plus --latency-per-kb for each KB of request and response
+# body, plus an exponentially distributed --jitter.  --error-rate answers that fraction of requests
+# with a 503, and bodies bigger than --max-request-size get a 413, like CouchDB's max_http_request_size.
+#
+# GET /_stats returns request counts, bytes and time spent per kind of request; DELETE /_stats resets them.
+#
+# keys are collated like CouchDB does (null, false, true, numbers, strings, arrays, objects), except
+# that strings are compared by code point rather than with ICU.
+#
+
+import sys, json, time, random, getopt, hashlib, threading, urlparse, bisect, collections
+import BaseHTTPServer, SocketServer
+
+args = {'--port' : '5984', '--latency' : '0', '--latency-per-kb' : '0', '--jitter' : '0', '--error-rate' : '0',\
+    '--max-request-size' : str(64 * 1024 * 1024)}
+args.update(dict(getopt.getopt(sys.argv[1:], '', ['port=', 'latency=', 'latency-per-kb=', 'jitter=', 'error-rate=',\
+    'max-request-size='])[0]))
+
+port = int(args['--port'])
+latency = float(args['--latency']) / 1000
+latency_per_kb = float(args['--latency-per-kb']) / 1000
+jitter = float(args['--jitter']) / 1000
+error_rate = float(args['--error-rate'])
+max_request_size = int(args['--max-request-size'])
+
+# everything below is guarded by this one lock; changes_condition wakes up long polls
+lock = threading.RLock()
+changes_condition = threading.Condition(lock)
+
+dbs = {}
+solr_docs = {}
+solr_handlers = {}
+stats = collections.defaultdict(lambda : {'requests' : 0, 'errors' : 0, 'bytes_in' : 0, 'bytes_out' : 0, 'seconds' : 0.0})
+
+class NotFound(Exception):
+  pass
+
+def collation_key(value):
+  if value is None:
+    return (0,)
+  if value is False:
+    return (1,)
+  if value is True:
+    return (2,)
+  if isinstance(value, (int, long, float)):
+    return (3, value)
+  if isinstance(value, basestring):
+    return (4, value)
+  if isinstance(value, list):
+    return (5, tuple(map(collation_key, value)))
+  return (6, tuple((collation_key(k), collation_key(v)) for (k, v) in sorted(value.items())))
+
+#
+# the map functions of the design docs in the scripts, in Python
+#
+
+def map_blocks_to_hints(doc):
+  if doc.get('type') == 'block_hint':
+    yield ([doc['blocks'], False], None)
+    if len(doc['blocks']) == 2:
+      yield ([[doc['blocks'][1], doc['blocks'][0]], True], None)
+
+def map_blocks_to_counts(doc):
+  if doc.get('type') == 'block_count':
+    yield (doc['block'], doc['count'])
+
+def map_counts_to_blocks(doc):
+  if 'soloHintCount' in doc:
+    yield (doc['soloHintCount'] + doc['followingHintCount'], None)
+
+VIEWS = {'blocks_to_hints' : map_blocks_to_hints, 'blocks_to_counts' : map_blocks_to_counts,\
+    'counts_to_blocks' : map_counts_to_blocks}
+
+class Database(object):
+
+  def __init__(self, name):
+    self.name = name
+    self.docs = {}
+    self.deleted = set()
+    self.seq = 0
+    self.doc_seqs = {} # doc id -> seq of its latest change
+    self.change_seqs = [] # every change, in order
+    self.change_ids = []
+    self.sorted_ids = None
+    self.views = {} # view name -> (seq it was built at, view_rows())
+
+  def changed(self, doc_id):
+    self.seq += 1
+    self.doc_seqs[doc_id] = self.seq
+    self.change_seqs.append(self.seq)
+    self.change_ids.append(doc_id)
+    self.sorted_ids = None
+
+  def put(self, doc):
+    # returns the result row _bulk_docs would give for this doc
+    doc_id = doc.get('_id') or hashlib.md5(str(random.random())).hexdigest()
+    old_doc = self.docs.get(doc_id)
+    if old_doc is not None and doc.get('_rev') != old_doc['_rev']:
+      return {'id' : doc_id, 'error' : 'conflict', 'reason' : 'Document update conflict.'}
+
+    rev_num = int(old_doc['_rev'].split('-')[0]) + 1 if old_doc is not None else 1
+    rev = '%d-%s' % (rev_num, hashlib.md5(json.dumps(doc, sort_keys=True)).hexdigest())
+    if doc.get('_deleted'):
+      if old_doc is None:
+        return {'id' : doc_id, 'error' : 'not_found', 'reason' : 'missing'}
+      del self.docs[doc_id]
+      self.deleted.add(doc_id)
+    else:
+      doc = dict(doc, _id=doc_id, _rev=rev)
+      self.docs[doc_id] = doc
+      self.deleted.discard(doc_id)
+    self.changed(doc_id)
+    return {'ok' : True, 'id' : doc_id, 'rev' : rev}
+
+  def get_sorted_ids(self):
+    # _all_docs collates ids by raw code point
+    if self.sorted_ids is None:
+      self.sorted_ids = sorted(self.docs)
+    return self.sorted_ids
+
+  def view_rows(self, view_name):
+    # returns the sorted collation keys and the matching (key, doc id, value) rows; rebuilt whenever
+    # the db has changed since
+    if view_name not in VIEWS:
+      raise NotFound()
+    (built_at, keys_and_rows) = self.views.get(view_name, (None, None))
+    if built_at != self.seq:
+      rows = []
+      for doc in self.docs.itervalues():
+        for (key, value) in VIEWS[view_name](doc):
+          rows.append((collation_key(key), doc['_id'], key, value))
+      rows.sort()
+      keys_and_rows = ([row[0] for row in rows], [(row[2], row[1], row[3]) for row in rows])
+      self.views[view_name] = (self.seq, keys_and_rows)
+    return keys_and_rows
+
+def get_db(name):
+  try:
+    return dbs[name]
+  except KeyError:
+    raise NotFound()
+
+def parse_json_params(params, names):
+  # CouchDB takes these query parameters as JSON
+  return dict((name, json.loads(params[name])) for name in names if name in params)
+
+def key_range(keys, ids, params, collate):
+  # the [start, end) slice of the sorted keys that key/startkey/endkey/inclusive_end/startkey_docid select
+  json_params = parse_json_params(params, ('key', 'startkey', 'endkey', 'start_key', 'end_key'))
+  if 'key' in json_params:
+    (startkey, endkey, inclusive_end) = (json_params['key'], json_params['key'], True)
+  else:
+    startkey = json_params.get('startkey', json_params.get('start_key'))
+    endkey = json_params.get('endkey', json_params.get('end_key'))
+    inclusive_end = params.get('inclusive_end', 'true') != 'false'
+
+  start = 0
+  if startkey is not None:
+    start = bisect.bisect_left(keys, collate(startkey))
+    startkey_docid = params.get('startkey_docid')
+    while startkey_docid and start < len(keys) and keys[start] == collate(startkey) and ids[start] < startkey_docid:
+      start += 1
+  end = len(keys)
+  if endkey is not None:
+    end = (bisect.bisect_right if inclusive_end else bisect.bisect_left)(keys, collate(endkey))
+  return (start, max(start, end))
+
+def page(start, end, params):
+  # applies skip and limit to a [start, end) slice
+  start = min(end, start + int(params.get('skip', 0)))
+  if 'limit' in params:
+    end = min(end, start + int(params['limit']))
+  return (start, end)
+
+def rows_result(total_rows, offset, rows):
+  # a plain dict would put rows first; CouchDB sends total_rows and offset in front of the rows, and
+  # couchdb_rows.py reads them from there while the rows are still streaming in
+  return collections.OrderedDict([('total_rows', total_rows), ('offset', offset), ('rows', rows)])
+
+def all_docs(db, params):
+  include_docs = params.get('include_docs') == 'true'
+  json_params = parse_json_params(params, ('keys',))
+
+  def make_row(doc_id):
+    row = {'id' : doc_id, 'key' : doc_id, 'value' : {'rev' : db.docs[doc_id]['_rev']}}
+    if include_docs:
+      row['doc'] = db.docs[doc_id]
+    return row
+
+  if 'keys' in json_params:
+    # missing docs get an error row, like CouchDB
+    rows = [make_row(key) if key in db.docs else {'key' : key, 'error' : 'not_found'} for key in json_params['keys']]
+    return rows_result(len(db.docs), 0, rows)
+
+  ids = db.get_sorted_ids()
+  (start, end) = key_range(ids, ids, params, lambda key : key)
+  (start, end) = page(start, end, params)
+  return rows_result(len(ids), start, [make_row(ids[i]) for i in xrange(start, end)])
+
+def view(db, view_name, params):
+  (keys, rows) = db.view_rows(view_name)
+  reduce_view = view_name == 'blocks_to_counts' and params.get('reduce', 'true') != 'false'
+  ids = [row[1] for row in rows] if params.get('startkey_docid') else None
+  (start, end) = key_range(keys, ids, params, collation_key)
+
+  if reduce_view:
+    # _sum, grouped by the whole key with group=true.  skip and limit apply to the groups.
+    group = params.get('group') == 'true'
+    skip = int(params.get('skip', 0))
+    num_groups = skip + int(params['limit']) if 'limit' in params else None
+    groups = []
+    for i in xrange(start, end):
+      (key, value) = (rows[i][0], rows[i][2])
+      if groups and (not group or groups[-1]['key'] == key):
+        groups[-1]['value'] += value
+      elif len(groups) == num_groups:
+        break
+      else:
+        groups.append({'key' : key if group else None, 'value' : value})
+    return {'rows' : groups[skip:]}
+
+  if 'keys' in params:
+    selected = []
+    for key in json.loads(params['keys']):
+      (key_start, key_end) = key_range(keys, ids, {'key' : json.dumps(key)}, collation_key)
+      selected += range(key_start, key_end)
+    selected = selected[int(params.get('skip', 0)):]
+    selected = selected[:int(params['limit'])] if 'limit' in params else selected
+  else:
+    selected = xrange(*page(start, end, params))
+
+  include_docs = params.get('include_docs') in ('true', True)
+  result_rows = []
+  for i in selected:
+    (key, doc_id, value) = rows[i]
+    result_row = {'id' : doc_id, 'key' : key, 'value' : value}
+    if include_docs:
+      result_row['doc'] = db.docs[doc_id]
+    result_rows.append(result_row)
+  return rows_result(len(rows), start, result_rows)
+
+def changes_since(db, params):
+  since = int(params.get('since', 0) or 0)
+  include_docs = params.get('include_docs') == 'true'
+  limit = int(params['limit']) if 'limit' in params else None
+
+  # the log has an entry for every change; only a doc's latest one counts
+  results = []
+  for i in xrange(bisect.bisect_right(db.change_seqs, since), len(db.change_seqs)):
+    (seq, doc_id) = (db.change_seqs[i], db.change_ids[i])
+    if db.doc_seqs[doc_id] != seq:
+      continue
+    change = {'seq' : seq, 'id' : doc_id}
+    if doc_id in db.deleted:
+      change['deleted'] = True
+      change['changes'] = []
+    else:
+      change['changes'] = [{'rev' : db.docs[doc_id]['_rev']}]
+      if include_docs:
+        change['doc'] = db.docs[doc_id]
+    results.append(change)
+    if limit is not None and len(results) == limit:
+      break
+  return {'results' : results, 'last_seq' : results[-1]['seq'] if results else max(since, 0)}
+
+def changes(db, params):
+  if params.get('feed') == 'longpoll':
+    deadline = time.time() + float(params.get('timeout', 60000)) / 1000
+    while db.seq <= int(params.get('since', 0) or 0) and time.time() < deadline:
+      changes_condition.wait(deadline - time.time())
+  return changes_since(db, params)
+
+def solr_update(body):
+  update = json.loads(body) if body else {}
+  # Solr's JSON allows repeated keys, but the scripts never send them
+  if 'add' in update:
+    adds = update['add'] if isinstance(update['add'], list) else [update['add']]
+    for doc in adds:
+      solr_docs[doc['id']] = doc
+  if 'delete' in update:
+    delete = update['delete']
+    if isinstance(delete, dict) and delete.get('query') == '*:*':
+      solr_docs.clear()
+    elif isinstance(delete, dict):
+      solr_docs.pop(delete.get('id'), None)
+    else:
+      for doc_id in delete:
+        solr_docs.pop(doc_id, None)
+  return {'responseHeader' : {'status' : 0, 'QTime' : 0}}
+
+def solr_config(body):
+  # the Config API, as far as request handlers go; they're only kept, since there are no queries
+  for (command, handler) in json.loads(body).items():
+    if command in ('add-requesthandler', 'update-requesthandler'):
+      solr_handlers[handler['name']] = handler
+  return {'responseHeader' : {'status' : 0, 'QTime' : 0}}
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def read_body(self):
+    if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+      chunks = []
+      while True:
+        size = int(self.rfile.readline().split(';')[0].strip(), 16)
+        if size == 0:
+          while self.rfile.readline().strip():
+            pass
+          break
+        chunks.append(self.rfile.read(size))
+        self.rfile.readline()
+      return ''.join(chunks)
+    return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+  def respond(self, kind, start_time, body_len, status, result):
+    body = json.dumps(result, separators=(',',':'))
+    delay = latency + latency_per_kb * (body_len + len(body)) / 1024.0
+    if jitter > 0:
+      delay += random.expovariate(1.0 / jitter)
+    time.sleep(delay)
+
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+    with lock:
+      kind_stats = stats[kind]
+      kind_stats['requests'] += 1
+      kind_stats['errors'] += 1 if status >= 400 else 0
+      kind_stats['bytes_in'] += body_len
+      kind_stats['bytes_out'] += len(body)
+      kind_stats['seconds'] += time.time() - start_time
+
+  def handle_request(self, method):
+    start_time = time.time()
+    url = urlparse.urlsplit(self.path)
+    params = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+    parts = [urlparse.unquote(part) for part in url.path.strip('/').split('/')] if url.path.strip('/') else []
+    body = self.read_body() if method in ('POST', 'PUT') else ''
+    kind = self.request_kind(method, parts)
+
+    if len(body) > max_request_size:
+      return self.respond(kind, start_time, len(body), 413, {'error' : 'too_large', 'reason' : 'the request entity is too large'})
+    if kind != 'stats' and random.random() < error_rate:
+      return self.respond(kind, start_time, len(body), 503, {'error' : 'service_unavailable', 'reason' : 'injected error'})
+
+    try:
+      with lock:
+        (status, result) = self.dispatch(method, parts, params, body)
+    except NotFound:
+      (status, result) = (404, {'error' : 'not_found', 'reason' : 'missing'})
+    except ValueError, e:
+      (status, result) = (400, {'error' : 'bad_request', 'reason' : str(e)})
+    self.respond(kind, start_time, len(body), status, result)
+
+  def request_kind(self, method, parts):
+    # what the stats are grouped by
+    if not parts:
+      return 'welcome'
+    if parts[0] == '_stats':
+      return 'stats'
+    if parts[0] == 'solr':
+      return 'solr ' + '/'.join(parts[1:])
+    if len(parts) == 1:
+      return method + ' db'
+    if parts[1] in ('_bulk_docs', '_all_docs', '_changes'):
+      return parts[1]
+    if parts[1] == '_design' and len(parts) >= 5:
+      return 'view ' + parts[4] + (' queries' if len(parts) > 5 else '')
+    return method + ' doc'
+
+  def dispatch(self, method, parts, params, body):
+    if not parts:
+      return (200, {'couchdb' : 'Welcome', 'version' : 'fake'})
+
+    if parts[0] == '_stats':
+      if method == 'DELETE':
+        stats.clear()
+      return (200, dict(stats, solr_docs=len(solr_docs), solr_handlers=solr_handlers, dbs=dict((name, len(db.docs)) for (name, db) in dbs.items())))
+
+    if parts[0] == 'solr':
+      if parts[-1] == 'config' and method == 'POST':
+        return (200, solr_config(body))
+      if parts[-1] not in ('update', 'json'):
+        raise NotFound()
+      return (200, solr_update(body))
+
+    db_name = parts[0]
+    if len(parts) == 1:
+      if method == 'PUT':
+        if db_name in dbs:
+          return (412, {'error' : 'file_exists', 'reason' : 'The database could not be created, the file already exists.'})
+        dbs[db_name] = Database(db_name)
+        return (201, {'ok' : True})
+      if method == 'DELETE':
+        get_db(db_name)
+        del dbs[db_name]
+        return (200, {'ok' : True})
+      db = get_db(db_name)
+      return (200, {'db_name' : db_name, 'doc_count' : len(db.docs), 'update_seq' : db.seq})
+
+    db = get_db(db_name)
+    if parts[1] == '_bulk_docs' and method == 'POST':
+      results = [db.put(doc) for doc in json.loads(body)['docs']]
+      changes_condition.notify_all()
+      return (201, results)
+    if parts[1] == '_all_docs':
+      if method == 'POST': # keys in the body
+        params = dict(params, keys=json.dumps(json.loads(body)['keys']))
+      return (200, all_docs(db, params))
+    if parts[1] == '_changes':
+      return (200, changes(db, params))
+    if parts[1] == '_design' and len(parts) >= 5 and parts[3] == '_view':
+      if len(parts) > 5 and parts[5] == 'queries':
+        queries = json.loads(body)['queries']
+        return (200, {'results' : [view(db, parts[4], self.query_params(query)) for query in queries]})
+      return (200, view(db, parts[4], params))
+
+    doc_id = '/'.join(parts[1:])
+    if method == 'PUT':
+      doc = json.loads(body)
+      doc['_id'] = doc_id
+      result = db.put(doc)
+      changes_condition.notify_all()
+      return (409, result) if 'error' in result else (201, result)
+    if method == 'DELETE':
+      result = db.put({'_id' : doc_id, '_rev' : params.get('rev'), '_deleted' : True})
+      changes_condition.notify_all()
+      return (409, result) if 'error' in result else (200, result)
+    if doc_id not in db.docs:
+      raise NotFound()
+    return (200, db.docs[doc_id])
+
+  def query_params(self, query):
+    # a query of a multi-query POST has JSON values; turn them into query parameters
+    params = {}
+    for (name, value) in query.items():
+      if name in ('key', 'keys', 'startkey', 'endkey', 'start_key', 'end_key'):
+        params[name] = json.dumps(value)
+      elif isinstance(value, bool):
+        params[name] = 'true' if value else 'false'
+      else:
+        params[name] = str(value)
+    return params
+
+  def do_GET(self):
+    self.handle_request('GET')
+
+  def do_POST(self):
+    self.handle_request('POST')
+
+  def do_PUT(self):
+    self.handle_request('PUT')
+
+  def do_DELETE(self):
+    self.handle_request('DELETE')
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+def main():
+  print "fake CouchDB/Solr listening on port %d" % port
+  Server(('', port), Handler).serve_forever()
+
+if __name__=='__main__':
+  main()
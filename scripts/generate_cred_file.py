@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# write a synthetic cred file, in the same -|- format as the real one, for testing and benchmarking
+# the pipeline at any size
+#
+# ./generate_cred_file.py [--lines N] [--blocks N] [--hints N] [--zipf S] [--long-passwords P]
+#     [--other-passwords P] [--no-hints P] [--bogus-hints P] [--overlong P] [--overlong-size N]
+#     [--seed N] [--output FILE]
+#
+# blocks and hints are drawn from vocabularies of --blocks and --hints strings with a Zipf distribution
+# of exponent --zipf, so that a few blocks and hints are very popular and most are rare, as in the real
+# dump.  Half of the hints are drawn from a small set of hints specific to the password's first block
+# instead, so that blocks have hints in common with each other.
+#
+# a --long-passwords fraction of passwords have 24 characters (two blocks), and --other-passwords have
+# lengths that can't be divided into blocks; the rest have 12.  --no-hints of the rows have an empty hint,
+# --bogus-hints have a hint that's only question marks, and --overlong have a hint of --overlong-size
+# characters.  The same --seed always writes the same file.
+#
+
+import sys, getopt, random, bisect, time
+
+BATCH_SIZE = 50000
+BLOCK_LENGTH = 11
+BASE64_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+OTHER_PASSWORD_LENGTHS = (8, 16, 32, 44)
+HINT_ALPHABET = 'abcdefghijklmnopqrstuvwxyz    '
+BOGUS_HINTS = ('?', '??', '???', '? ?', '????????')
+HINTS_PER_BLOCK = 8 # size of each block's own set of hints
+HINT_WORDS = ['the', 'usual', 'my', 'dog', 'cat', 'name', 'birthday', 'mom', 'old', 'same', 'password', 'work',\
+    'pet', 'car', 'street', 'first', 'school', 'team', 'favorite', 'number', 'color', 'love', 'wife', 'son',\
+    'daughter', 'city', 'home', 'phone', 'game', 'band', 'movie', 'food', 'caf\xc3\xa9', 'ma\xc3\xb1ana', 'stra\xc3\x9fe']
+
+args = {'--lines' : '1000000', '--blocks' : None, '--hints' : None, '--zipf' : '1.1', '--long-passwords' : '0.3',\
+    '--other-passwords' : '0.05', '--no-hints' : '0.3', '--bogus-hints' : '0.02', '--overlong' : '0.0005',\
+    '--overlong-size' : '4096', '--seed' : '0', '--output' : 'cred'}
+args.update(dict(getopt.getopt(sys.argv[1:], '', ['lines=', 'blocks=', 'hints=', 'zipf=', 'long-passwords=',\
+    'other-passwords=', 'no-hints=', 'bogus-hints=', 'overlong=', 'overlong-size=', 'seed=', 'output='])[0]))
+
+num_lines = int(args['--lines'])
+num_blocks = int(args['--blocks'] or max(1, num_lines / 10))
+num_hints = int(args['--hints'] or max(1, num_lines / 20))
+zipf_exponent = float(args['--zipf'])
+long_password_rate = float(args['--long-passwords'])
+other_password_rate = float(args['--other-passwords'])
+no_hint_rate = float(args['--no-hints'])
+bogus_hint_rate = float(args['--bogus-hints'])
+overlong_rate = float(args['--overlong'])
+overlong_size = int(args['--overlong-size'])
+output_filename = args['--output']
+
+rand = random.Random(int(args['--seed']))
+
+class ZipfSampler(object):
+  # draws ranks 0..n-1 with probability proportional to 1/(rank+1)^s, by bisecting the cumulative weights
+
+  def __init__(self, n, s):
+    self.cumulative_weights = []
+    total = 0.0
+    for rank in xrange(n):
+      total += 1.0 / (rank + 1) ** s
+      self.cumulative_weights.append(total)
+    self.total = total
+
+  def sample(self):
+    return min(bisect.bisect(self.cumulative_weights, rand.random() * self.total), len(self.cumulative_weights) - 1)
+
+def random_string(length, alphabet=BASE64_ALPHABET):
+  return ''.join(rand.choice(alphabet) for i in xrange(length))
+
+def random_hint():
+  return ' '.join(rand.choice(HINT_WORDS) for i in xrange(rand.randint(1, 4))) + ' ' + str(rand.randint(0, 9999))
+
+def create_password(blocks, block_sampler):
+  draw = rand.random()
+  if draw < other_password_rate:
+    return (random_string(rand.choice(OTHER_PASSWORD_LENGTHS)), None)
+  first_block_rank = block_sampler.sample()
+  if draw < other_password_rate + long_password_rate:
+    return (blocks[first_block_rank] + blocks[block_sampler.sample()] + '==', first_block_rank)
+  return (blocks[first_block_rank] + '=', first_block_rank)
+
+def create_hint(first_block_rank, hints, hint_sampler, block_hint_sampler):
+  draw = rand.random()
+  if draw < no_hint_rate:
+    return ''
+  draw -= no_hint_rate
+  if draw < bogus_hint_rate:
+    return rand.choice(BOGUS_HINTS)
+  draw -= bogus_hint_rate
+  if draw < overlong_rate:
+    return random_string(overlong_size, HINT_ALPHABET)
+  if first_block_rank is None or rand.random() < 0.5:
+    return hints[hint_sampler.sample()]
+  return hints[(first_block_rank * 7919 + block_hint_sampler.sample()) % len(hints)]
+
+def main():
+  start_time = time.time()
+  print 'creating %d blocks and %d hints...' % (num_blocks, num_hints)
+  blocks = [random_string(BLOCK_LENGTH) for i in xrange(num_blocks)]
+  hints = [random_hint() for i in xrange(num_hints)]
+  block_sampler = ZipfSampler(num_blocks, zipf_exponent)
+  hint_sampler = ZipfSampler(num_hints, zipf_exponent)
+  block_hint_sampler = ZipfSampler(HINTS_PER_BLOCK, zipf_exponent)
+
+  with open(output_filename, 'wb') as f:
+    lines = []
+    for line_number in xrange(num_lines):
+      (password, first_block_rank) = create_password(blocks, block_sampler)
+      hint = create_hint(first_block_rank, hints, hint_sampler, block_hint_sampler)
+      lines.append('%d-|--|-user%d@example.com-|-%s-|-%s|--\n' % (line_number, line_number, password, hint))
+      if len(lines) == BATCH_SIZE:
+        f.writelines(lines)
+        del lines[:]
+        print 'wrote %d/%d lines to %s so far...' % (line_number + 1, num_lines, output_filename)
+    f.writelines(lines)
+
+  print 'done, wrote %d lines to %s in %.1fs' % (num_lines, output_filename, time.time() - start_time)
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,35 @@
+#
+# rank a block's hints by count, either keeping only the top k or ordering all of them
+#
+# used by compute_optimized_couchdb.py (top hints in each summary) and compute_mini_block_hints.py
+# (every hint, in order)
+#
+
+import heapq
+
+ASCENDING = 'ascending'
+DESCENDING = 'descending'
+
+def rank_hints(hint_map, k=None, tie_break=ASCENDING):
+  # returns (hint, count) pairs sorted by count descending, with equal counts ordered by hint
+  # according to tie_break; only the top k pairs if k is given
+  if k is not None and k < len(hint_map):
+    # bounded heap, O(n log k) instead of sorting everything
+    if tie_break == ASCENDING:
+      return heapq.nsmallest(k, hint_map.iteritems(), key=lambda (hint, count) : (-count, hint))
+    return heapq.nlargest(k, hint_map.iteritems(), key=lambda (hint, count) : (count, hint))
+  
+  # counting sort; there are far fewer distinct counts than there are hints
+  counts_to_hints = {}
+  for (hint, count) in hint_map.iteritems():
+    try:
+      counts_to_hints[count].append(hint)
+    except KeyError:
+      counts_to_hints[count] = [hint]
+  
+  result = []
+  for count in sorted(counts_to_hints.keys(), reverse=True):
+    hints = counts_to_hints[count]
+    hints.sort(reverse=(tie_break == DESCENDING))
+    result += [(hint, count) for hint in hints]
+  return result
@@ -0,0 +1,168 @@
+#
+# the two ways index_docs_in_solr.py weights a doc's hints in Solr
+#
+# repeat: every hint is sent count times, into the hints field (text_general), so that each of its
+# tokens gets count more to its term frequency.
+#
+# termfreq: every token is sent once as "token|frequency", into the hints_tf field (text_tf, see
+# solr/schema.xml), whose DelimitedTermFrequencyTokenFilter makes the frequency the term frequency.
+# The frequency is the sum of the counts of the hints the token is in, which is what repeating them
+# adds up to.
+#
+# for that to hold, tokenize() has to split a hint into the same tokens as the StandardTokenizer of
+# text_general, which breaks words by the rules of Unicode UAX#29.  Those rules are written out below
+# the way Lucene's StandardTokenizerImpl.jflex does, with the word break classes of UAX#29 worked out
+# from the general categories of unicodedata and a few script ranges (Python has no script property),
+# so characters that are newer than Python's Unicode data, or in scripts that aren't listed, can still
+# come out differently.  check_hint_weighting.py compares the two against a real Solr's analyzers.
+#
+
+import re, sys, unicodedata
+
+FREQUENCY_DELIMITER = '|'
+MAX_TOKEN_LENGTH = 255 # StandardTokenizer's default; it splits longer tokens at this length
+
+HAN_RANGES = ((0x2E80, 0x2FDF), (0x3005, 0x3005), (0x3007, 0x3007), (0x3021, 0x3029), (0x3038, 0x303B),\
+    (0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF), (0x20000, 0x2FA1F))
+KATAKANA_RANGES = ((0x3031, 0x3035), (0x309B, 0x309C), (0x30A0, 0x30FA), (0x30FC, 0x30FF), (0x31F0, 0x31FF),\
+    (0x32D0, 0x32FE), (0x3300, 0x3357), (0xFF66, 0xFF9D), (0x1B000, 0x1B000))
+HIRAGANA_RANGES = ((0x3041, 0x309F), (0x1B001, 0x1B11F), (0x1F200, 0x1F200))
+# Thai, Lao, Myanmar, Khmer and the other scripts written without spaces, which StandardTokenizer
+# leaves in runs for a dictionary-based tokenizer to break up
+SOUTHEAST_ASIAN_RANGES = ((0x0E00, 0x0EFF), (0x1000, 0x109F), (0x1780, 0x17FF), (0x1950, 0x19DF),\
+    (0x1A20, 0x1AAF), (0xA9E0, 0xA9FF), (0xAA60, 0xAADF))
+HEBREW_LETTER_RANGES = ((0x05D0, 0x05EA), (0x05EF, 0x05F2), (0xFB1D, 0xFB1D), (0xFB1F, 0xFB28), (0xFB2A, 0xFB4F))
+EXTEND_RANGES = ((0x200C, 0x200D), (0xFF9E, 0xFF9F)) # besides the marks
+EXTEND_NUM_LET_RANGES = ((0x202F, 0x202F),) # besides the connector punctuation, e.g. _
+MID_LETTER = u':\u00b7\u0387\u05f4\u2027\ufe13\ufe55\uff1a'
+MID_NUM_LET = u'.\u2018\u2019\u2024\ufe52\uff07\uff0e'
+MID_NUM = u',;\u037e\u0589\u060c\u060d\u066c\u07f8\u2044\ufe10\ufe14\ufe50\ufe54\uff0c\uff1b'
+# emoji that are emoji on their own, the ones that are only emoji followed by U+FE0F, and the skin tones
+EMOJI_RANGES = ((0x231A, 0x231B), (0x23E9, 0x23EC), (0x23F0, 0x23F0), (0x23F3, 0x23F3), (0x25FD, 0x25FE),\
+    (0x2614, 0x2615), (0x2648, 0x2653), (0x267F, 0x267F), (0x2693, 0x2693), (0x26A1, 0x26A1), (0x26AA, 0x26AB),\
+    (0x26BD, 0x26BE), (0x26C4, 0x26C5), (0x26CE, 0x26CE), (0x26D4, 0x26D4), (0x26EA, 0x26EA), (0x26F2, 0x26F3),\
+    (0x26F5, 0x26F5), (0x26FA, 0x26FA), (0x26FD, 0x26FD), (0x2705, 0x2705), (0x270A, 0x270B), (0x2728, 0x2728),\
+    (0x274C, 0x274C), (0x274E, 0x274E), (0x2753, 0x2755), (0x2757, 0x2757), (0x2795, 0x2797), (0x27B0, 0x27B0),\
+    (0x27BF, 0x27BF), (0x2B1B, 0x2B1C), (0x2B50, 0x2B50), (0x2B55, 0x2B55), (0x1F004, 0x1F004),\
+    (0x1F0CF, 0x1F0CF), (0x1F18E, 0x1F18E), (0x1F191, 0x1F19A), (0x1F201, 0x1F202), (0x1F21A, 0x1F21A),\
+    (0x1F22F, 0x1F22F), (0x1F232, 0x1F23A), (0x1F250, 0x1F251), (0x1F300, 0x1F3FA), (0x1F400, 0x1F64F),\
+    (0x1F680, 0x1F6FF), (0x1F7E0, 0x1F7EB), (0x1F900, 0x1F9FF), (0x1FA70, 0x1FAFF))
+TEXT_EMOJI_RANGES = ((0x00A9, 0x00A9), (0x00AE, 0x00AE), (0x203C, 0x203C), (0x2049, 0x2049), (0x2122, 0x2122),\
+    (0x2139, 0x2139), (0x2194, 0x21AA), (0x2328, 0x2328), (0x23CF, 0x23CF), (0x23ED, 0x23EF), (0x23F1, 0x23F2),\
+    (0x23F8, 0x23FA), (0x24C2, 0x24C2), (0x25AA, 0x25AB), (0x25B6, 0x25B6), (0x25C0, 0x25C0), (0x25FB, 0x25FC),\
+    (0x2600, 0x27BF), (0x2934, 0x2935), (0x2B05, 0x2B07), (0x3030, 0x3030), (0x303D, 0x303D), (0x3297, 0x3297),\
+    (0x3299, 0x3299), (0x1F170, 0x1F171), (0x1F17E, 0x1F17F), (0x1F202, 0x1F202), (0x1F237, 0x1F237))
+EMOJI_MODIFIER_RANGES = ((0x1F3FB, 0x1F3FF),)
+REGIONAL_INDICATOR_RANGES = ((0x1F1E6, 0x1F1FF),)
+
+def in_ranges(code_point, ranges):
+  for (start, end) in ranges:
+    if start <= code_point <= end:
+      return True
+  return False
+
+def word_break_class(code_point):
+  # the UAX#29 class of a code point, as far as StandardTokenizer cares, or None
+  category = unicodedata.category(unichr(code_point))
+  if category in ('Cn', 'Co', 'Cs'): # most of them, so get them out of the way first
+    return None
+  if in_ranges(code_point, EXTEND_RANGES) or category in ('Mn', 'Me', 'Mc'):
+    return 'extend'
+  if category == 'Cf' and code_point != 0x200B:
+    return 'format'
+  if category == 'Nd':
+    return 'numeric'
+  if in_ranges(code_point, KATAKANA_RANGES):
+    return 'katakana'
+  if in_ranges(code_point, HAN_RANGES) or in_ranges(code_point, HIRAGANA_RANGES):
+    return 'ideographic'
+  if in_ranges(code_point, SOUTHEAST_ASIAN_RANGES):
+    return 'southeast_asian'
+  if in_ranges(code_point, HEBREW_LETTER_RANGES):
+    return 'hebrew_letter'
+  if category in ('Lu', 'Ll', 'Lt', 'Lm', 'Lo', 'Nl'):
+    return 'letter'
+  if category == 'Pc' or in_ranges(code_point, EXTEND_NUM_LET_RANGES):
+    return 'extend_num_let'
+  return None
+
+def char_class(code_points):
+  # a regex character class matching the given (sorted) code points
+  ranges = []
+  for code_point in code_points:
+    if len(ranges) > 0 and ranges[-1][1] == code_point - 1:
+      ranges[-1][1] = code_point
+    else:
+      ranges.append([code_point, code_point])
+  return u'[' + u''.join([re.escape(unichr(start)) if start == end else\
+      u'%s-%s' % (re.escape(unichr(start)), re.escape(unichr(end))) for (start, end) in ranges]) + u']'
+
+def ranges_class(ranges):
+  return char_class([code_point for (start, end) in ranges for code_point in range(start, end + 1)])
+
+def token_pattern():
+  # StandardTokenizerImpl.jflex as a regex, for a scanner that skips whatever doesn't start a token
+  classes = {}
+  for code_point in xrange(sys.maxunicode + 1):
+    word_break = word_break_class(code_point)
+    if word_break is not None:
+      classes.setdefault(word_break, []).append(code_point)
+
+  # UAX#29 WB4: extend and format characters belong to the character in front of them
+  x = u'(?:%s|%s)*' % (char_class(classes['extend']), char_class(classes['format']))
+  def ex(char_class):
+    return u'(?:%s%s)' % (char_class, x)
+
+  hebrew_letter = ex(char_class(classes['hebrew_letter']))
+  letter = ex(char_class(classes['letter'] + classes['hebrew_letter']))
+  numeric = ex(char_class(classes['numeric']))
+  katakana = ex(char_class(classes['katakana']))
+  extend_num_let = ex(char_class(classes['extend_num_let']))
+  mid_letter = ex(u'[%s%s\']' % (re.escape(MID_LETTER), re.escape(MID_NUM_LET)))
+  mid_numeric = ex(u'[%s%s\']' % (re.escape(MID_NUM), re.escape(MID_NUM_LET)))
+
+  katakana_run = u'%s(?:%s*%s)*' % (katakana, extend_num_let, katakana)
+  numeric_run = u'%s(?:(?:%s*|%s)%s)*' % (numeric, extend_num_let, mid_numeric, numeric)
+  letter_run = u'%s(?:(?:%s*|%s)%s)*' % (letter, extend_num_let, mid_letter, letter)
+  hebrew_quote = u'%s(?:\'%s|"%s%s)' % (hebrew_letter, x, x, hebrew_letter)
+  runs = u'(?:%s|(?:%s|%s|%s)+)' % (katakana_run, hebrew_quote, numeric_run, letter_run)
+  word = u'%s*%s(?:%s+%s)*%s*' % (extend_num_let, runs, extend_num_let, runs, extend_num_let)
+
+  emoji = u'(?:%s|%s\ufe0f)(?:\ufe0f|%s)*' % (ranges_class(EMOJI_RANGES), ranges_class(TEXT_EMOJI_RANGES),\
+      ranges_class(EMOJI_MODIFIER_RANGES))
+  emoji_sequence = u'(?:%s{2}|[#*0-9]\ufe0f?\u20e3|%s(?:\u200d%s)*)' % (ranges_class(REGIONAL_INDICATOR_RANGES),\
+      emoji, emoji)
+  ideographic = ex(char_class(classes['ideographic']))
+  southeast_asian_run = ex(char_class(classes['southeast_asian'])) + u'+'
+
+  return re.compile(u'|'.join([emoji_sequence, word, ideographic, southeast_asian_run]), re.UNICODE)
+
+TOKEN = token_pattern()
+
+def tokenize(hint):
+  # the terms StandardTokenizer and LowerCaseFilter make of a hint, in order
+  tokens = []
+  for match in TOKEN.finditer(hint):
+    token = match.group().lower()
+    for i in range(0, len(token), MAX_TOKEN_LENGTH):
+      tokens.append(token[i:i + MAX_TOKEN_LENGTH])
+  return tokens
+
+def repeated_hints(hint_map):
+  hints = []
+  for (hint, count) in hint_map.items():
+    for i in range(count):
+      hints.append(hint)
+  return hints
+
+def term_frequencies(hint_map):
+  # token -> the term frequency that repeating every hint count times would have added up to
+  frequencies = {}
+  for (hint, count) in hint_map.items():
+    for token in tokenize(hint):
+      frequencies[token] = frequencies.get(token, 0) + count
+  return frequencies
+
+def term_frequency_value(hint_map):
+  return ' '.join(['%s%s%d' % (token, FREQUENCY_DELIMITER, frequency)\
+      for (token, frequency) in term_frequencies(hint_map).items()])
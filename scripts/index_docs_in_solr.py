@@ -3,35 +3,118 @@
 # Read docs from the optimized CouchDB, load them in Solr
 # Deletes all documents in Solr before adding them!
 #
-import requests, json
+# ./index_docs_in_solr.py [--mode full/incremental] [--state FILE] [--follow]
+#     [--transformers N] [--posters N] [--commit-within MS] [--hint-weighting termfreq/repeat]
+#     [--pair-dedup ordered/set] [--metrics FILE]
+#     [--profile FILE] [--profile-mode sample/timing]
+#
+# reading from CouchDB, turning rows into Solr docs and posting them to Solr all run at the same time,
+# connected by bounded queues.  Solr commits within --commit-within ms of each post instead of after
+# every post; there's one explicit commit and optimize at the end.
+#
+# the last _changes sequence of each db is kept in the --state file.  A full run records where the dbs
+# were when it started; --mode incremental then only applies what changed since (adds and deletes),
+# without deleting anything else from Solr.  With --follow it keeps long-polling _changes forever.  A
+# sequence is only saved once everything before it has been posted; any response from Solr that is still
+# not a success after couchdb_client.py's retries stops the run with a SolrError.
+#
+# --hint-weighting repeat (the default) sends each hint count times, into the hints field.  With
+# --hint-weighting termfreq, every token of a doc's hints is sent once along with how many times it
+# occurs, into the hints_tf field instead (see hint_weighting.py).  A full run points the df of Solr's
+# /select at the field it filled, through the Config API, and records the weighting in the --state
+# file; an incremental run with the other one refuses to start.  termfreq gives the same term
+# frequencies in a fraction of the bytes, but stays opt-in: hints_tf has no positions, so phrase queries
+# on it fail where they work on hints, and the queries are made by the app, not here.  Run
+# check_hint_weighting.py against the Solr in question before switching.
+#
+# every two-block sequence is stored twice in related_blocks, once under each block.  --pair-dedup
+# ordered indexes only the copy under the lower block id, which needs no memory and works the same in
+# incremental runs.  --pair-dedup set remembers the sequences seen so far instead, keeping whichever copy
+# comes first.  Both index every sequence once, with the same hints and count; only the id of the copy
+# can differ.
+#
+# with --metrics FILE, the rows read, docs built and docs posted per second, the time spent transforming
+# each batch and the depths of both queues are written to FILE every few seconds (see metrics.py)
+#
+# with --profile FILE, the transformers (couch_row_to_solr_doc and friends) and the posts to Solr are
+# profiled into FILE (see profiling.py)
+#
+import json, os, sys, time, getopt
+import couchdb_client, couchdb_rows, hint_weighting, interning, metrics, profiling, pipeline_config
+import gevent.monkey
+gevent.monkey.patch_socket()
+from gevent.queue import Queue
+import gevent
 
-COUCHDB_SUMMARIES_URL = 'http://localhost:5984/block_summaries'
-COUCHDB_RELATED_URL = 'http://localhost:5984/related_blocks'
-COUCHDB_HINTS_URL = 'http://localhost:5984/block_hints'
+COUCHDB_SUMMARIES_URL = pipeline_config.couchdb_url('block_summaries')
+COUCHDB_RELATED_URL = pipeline_config.couchdb_url('related_blocks')
+COUCHDB_HINTS_URL = pipeline_config.couchdb_url('block_hints')
 
-SOLR_URL = 'http://localhost:8983/solr'
+SOLR_URL = pipeline_config.solr_url()
 
 COUCHDB_BULK_SIZE = 10000
 COUCHDB_NUM_KEYS_IN_GETS = 200
+SOLR_BULK_SIZE = 1000
+QUEUE_SIZE = 4 # batches waiting between two stages
+CHANGES_BATCH_SIZE = 1000
+CHANGES_TIMEOUT = 60000 # ms a long poll waits for changes
 
+SOURCES = ((COUCHDB_SUMMARIES_URL, 'summary'), (COUCHDB_RELATED_URL, 'related'))
+HINT_FIELDS = {'repeat' : 'hints', 'termfreq' : 'hints_tf'}
+
+args = {'--mode' : 'full', '--state' : 'index_docs_in_solr.state', '--transformers' : '4', '--posters' : '4',\
+    '--commit-within' : '60000', '--hint-weighting' : 'repeat', '--pair-dedup' : 'ordered', '--metrics' : None,\
+    '--profile' : None, '--profile-mode' : 'sample'}
+args.update(dict(getopt.getopt(sys.argv[1:], '', ['mode=', 'state=', 'follow', 'transformers=', 'posters=', 'commit-within=',\
+    'hint-weighting=', 'pair-dedup=', 'metrics=', 'profile=', 'profile-mode='])[0]))
+
+mode = args['--mode']
+state_file = args['--state']
+follow = '--follow' in args
+num_transformers = int(args['--transformers'])
+num_posters = int(args['--posters'])
+commit_within = int(args['--commit-within'])
+weighting = args['--hint-weighting']
+pair_dedup = args['--pair-dedup']
+
+metrics.start(args['--metrics'])
+profiling.start(args['--profile'], args['--profile-mode'])
+
+# two readers, plus the transformers fetching full hints, plus the posters
+couchdb_client.configure(2 + num_transformers + num_posters)
+
+# packed (preceding block id, following block id) sequences seen so far, for --pair-dedup set
 related_blocks_already_processed = set()
 
+class SolrError(Exception):
+  pass
+
 # there are duplicates, because we store both the reverse and the forward of every two-block sequence,
 # so we need to be careful not to insert duplicates
-def already_processed_related(related_block):
-  if ('_id' not in related_block['doc'] or '~' not in related_block['doc']['_id']): # not a related block
+def related_pair(related_block):
+  # (block id, related block id), or None if the row isn't a related block
+  doc = related_block['doc']
+  if ('_id' not in doc or '~' not in doc['_id']): # not a related block
+    return None
+  return (int(doc['_id'].split('~', 1)[0]), doc['block'])
+
+def is_duplicate_related(related_block):
+  pair = related_pair(related_block)
+  if pair is None:
     return False
   
-  unique_id = tuple(sorted([int(related_block['doc']['_id'].split('~')[0]),related_block['doc']['block']]))
+  if pair_dedup == 'ordered':
+    # keep the copy stored under the lower block id; a block that follows itself has both copies in
+    # its own doc, so keep the following one
+    return pair[0] > pair[1] or (pair[0] == pair[1] and related_block['doc']['preceding'])
   
-  return unique_id in related_blocks_already_processed
-  
-def mark_related_as_processed(related_block):
-  if ('_id' not in related_block['doc'] or '~' not in related_block['doc']['_id']): # not a related block
-    return False
-    
-  unique_id = tuple(sorted([int(related_block['doc']['_id'].split('~')[0]),related_block['doc']['block']]))
-  related_blocks_already_processed.add(unique_id)
+  # keep whichever copy comes first.  The copy under the preceding block has preceding=false, so both
+  # copies of a sequence pack into the same key, while its reverse gets a key of its own.
+  key = interning.pack_ids((pair[1], pair[0]) if related_block['doc']['preceding'] else pair)
+  if key in related_blocks_already_processed:
+    return True
+  related_blocks_already_processed.add(key)
+  return False
 
 def enhance_with_full_hints(rows):
   # fetch hints from the block_hints database if necessary
@@ -47,7 +130,7 @@ def enhance_with_full_hints(rows):
     limit = min(len(keys), i + COUCHDB_NUM_KEYS_IN_GETS)
     params = {'keys' : json.dumps(keys[i:limit],separators=(',',':')), 'include_docs' : 'true'}
     
-    rows += requests.get(COUCHDB_HINTS_URL + '/_all_docs', params=params).json()['rows']
+    rows += couchdb_client.get(COUCHDB_HINTS_URL + '/_all_docs', params=params).json()['rows']
     
   
   ids_to_hints = dict(map(lambda row : (row['key'], row['doc']['hintMap']), rows))
@@ -56,61 +139,202 @@ def enhance_with_full_hints(rows):
     if 'hintsRedacted' in row['doc'] and row['doc']['hintsRedacted']:
       row['doc']['hintMap'] = ids_to_hints[row['doc']['_id']]
 
+
+def couch_row_to_solr_doc(row, doc_type):
+  doc = row['doc']
+
+  solr_doc = {\
+      'id' : doc['_id'],\
+      'docType' : doc_type,\
+      'popularity' : doc['count'] if doc_type == 'related' else (doc['soloHintCount'] + doc['followingHintCount'])}  
   
-def main():
+  if weighting == 'termfreq':
+    # each token once, as token|frequency, see text_tf in solr/schema.xml
+    solr_doc['hints_tf'] = hint_weighting.term_frequency_value(doc['hintMap'])
+  else:
+    # repeat the repeated hints so solr can weight them properly
+    solr_doc['hints'] = hint_weighting.repeated_hints(doc['hintMap'])
+  return solr_doc
+
+def read_rows(couchdb_url, doc_type, rows_queue):
+  params = {'include_docs' : 'true'}
+  rows = []
+  for row in couchdb_rows.iter_rows(couchdb_url + '/_all_docs', params=params, page_size=COUCHDB_BULK_SIZE):
+    rows.append(row)
+    if len(rows) == COUCHDB_BULK_SIZE:
+      print "read %d docs from couch %s" % (len(rows), couchdb_url)
+      metrics.inc('stage_items_total', len(rows), stage='read')
+      rows_queue.put((doc_type, rows))
+      rows = []
+  if len(rows) > 0:
+    print "read %d docs from couch %s" % (len(rows), couchdb_url)
+    metrics.inc('stage_items_total', len(rows), stage='read')
+    rows_queue.put((doc_type, rows))
+
+def rows_to_solr_docs(rows, doc_type):
+  # filter design documents, hintless documents and mirrored related blocks
+  filtered_rows = filter(lambda row : ('hintMap' in row['doc']) and (len(row['doc']['hintMap'].keys()) > 0) and (not is_duplicate_related(row)), rows)
   
-  print "Deleting all docs in Solr"
-  delete_response = requests.post(SOLR_URL + '/update/json', params={'commit' : 'true'},\
-      headers={'Content-Type' : 'application/json'},data=json.dumps({'delete' : {'query' : '*:*'}}))
-  print "Response was",delete_response.status_code
-
-  for (couchdb_url, doc_type) in zip((COUCHDB_SUMMARIES_URL, COUCHDB_RELATED_URL), ('summary', 'related')):
-    params = {'limit' : COUCHDB_BULK_SIZE,'include_docs' : 'true'}
-  
-    def couch_row_to_solr_doc(row):
-      doc = row['doc']
-
-      # repeat the repeated hints so solr can weight them properly
-      hints = []
-      for (hint, count) in doc['hintMap'].items():
-        for i in range(count):
-          hints.append(hint)
-
-      return {\
-          'id' : doc['_id'],\
-          'hints' : hints,\
-          'docType' : doc_type,\
-          'popularity' : doc['count'] if doc_type == 'related' else (doc['soloHintCount'] + doc['followingHintCount'])}  
-  
-    while True:
-      response = requests.get(couchdb_url + '/_all_docs', params=params)
-      print "called couch %s, got response code %d" % (couchdb_url, response.status_code)
-      rows = response.json()['rows']
-    
-      if len(rows) == 0:
-        break
-          
-      # filter design documents and hintless documents
-      filtered_rows = filter(lambda row : ('hintMap' in row['doc']) and (len(row['doc']['hintMap'].keys()) > 0) and (not already_processed_related(row)), rows)
-    
-      for row in filtered_rows:
-        mark_related_as_processed(row)
-    
-      enhanced_rows = enhance_with_full_hints(filtered_rows)
-    
-      solr_docs = map(couch_row_to_solr_doc, filtered_rows)
+  enhanced_rows = enhance_with_full_hints(filtered_rows)
+  
+  return [couch_row_to_solr_doc(row, doc_type) for row in filtered_rows]
+
+def transform_rows(rows_queue, docs_queue):
+  for (doc_type, rows) in rows_queue:
+    start_time = time.time()
+    solr_docs = rows_to_solr_docs(rows, doc_type)
+    metrics.observe('stage_batch_seconds', time.time() - start_time, stage='transform')
+    metrics.inc('stage_items_total', len(solr_docs), stage='transform')
+    for i in range(0, len(solr_docs), SOLR_BULK_SIZE):
+      docs_queue.put(solr_docs[i:i + SOLR_BULK_SIZE])
+
+def check_solr_response(response):
+  # couchdb_client.py has already retried any 5xx, so whatever isn't a success by now is an error
+  if response.status_code / 100 != 2:
+    raise SolrError('got response %d from %s: %s' % (response.status_code, response.url, response.text[:1000]))
+  return response
+
+def post_to_solr(update):
+  # solr commits on its own, within commit_within ms of each post
+  return check_solr_response(couchdb_client.post(SOLR_URL + '/update/json', params={'commitWithin' : commit_within},\
+      headers={'Content-Type' : 'application/json'},data=json.dumps(update)))
+
+def post_docs(docs_queue):
+  for solr_docs in docs_queue:
+    solr_response = post_to_solr({'add' : solr_docs})
+    print "Posted %d docs to solr, response was %d" % (len(solr_docs), solr_response.status_code)
+    metrics.inc('stage_items_total', len(solr_docs), stage='post')
+
+def point_queries_at(field):
+  # Solr 7 has no defaultSearchField, so /select is given a df instead: Solr's own /select, plus the df
+  update = {'update-requesthandler' : {'name' : '/select', 'class' : 'solr.SearchHandler',\
+      'defaults' : {'echoParams' : 'explicit', 'rows' : 10, 'df' : field}}}
+  response = couchdb_client.post(SOLR_URL + '/config', headers={'Content-Type' : 'application/json'},data=json.dumps(update))
+  print "Pointed /select at %s, response was %d" % (field, check_solr_response(response).status_code)
+
+def load_state():
+  # db url -> last _changes sequence applied to solr
+  try:
+    with open(state_file) as f:
+      return json.load(f)
+  except IOError:
+    return {}
+
+def save_state(state):
+  # write to a temp file and rename it over the old one, so a crash never leaves a half-written file
+  with open(state_file + '.tmp', 'w') as f:
+    json.dump(state, f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(state_file + '.tmp', state_file)
+
+def apply_changes(changes, doc_type):
+  deleted_ids = [change['id'] for change in changes if change.get('deleted')]
+  rows = [{'id' : change['id'], 'doc' : change['doc']} for change in changes\
+      if not change.get('deleted') and not change['id'].startswith('_design/')]
+  reindex_rows(rows, doc_type, deleted_ids)
+
+def reindex_rows(rows, doc_type, deleted_ids):
+  solr_docs = rows_to_solr_docs(rows, doc_type)
+  
+  # docs that are left out now (no hints anymore, or the other half of a related pair) come out of the index
+  indexed_ids = set(solr_doc['id'] for solr_doc in solr_docs)
+  deleted_ids += [row['id'] for row in rows if row['id'] not in indexed_ids]
+  
+  if len(deleted_ids) > 0:
+    print "Deleted %d docs from solr, response was %d" % (len(deleted_ids), post_to_solr({'delete' : deleted_ids}).status_code)
+  for i in range(0, len(solr_docs), SOLR_BULK_SIZE):
+    solr_response = post_to_solr({'add' : solr_docs[i:i + SOLR_BULK_SIZE]})
+    print "Posted %d docs to solr, response was %d" % (len(solr_docs[i:i + SOLR_BULK_SIZE]), solr_response.status_code)
+
+def follow_changes(couchdb_url, apply, state):
+  params = {'include_docs' : 'true', 'limit' : CHANGES_BATCH_SIZE}
+  if follow:
+    params.update({'feed' : 'longpoll', 'timeout' : CHANGES_TIMEOUT})
   
-      solr_response = requests.post(SOLR_URL + '/update/json', params={'commit' : 'true'},\
-          headers={'Content-Type' : 'application/json'},data=json.dumps({'add' : solr_docs}))
+  while True:
+    params['since'] = state.get(couchdb_url, 0)
+    response = couchdb_client.get(couchdb_url + '/_changes', params=params).json()
+    changes = response['results']
     
-      print "Posted %d docs to solr, response was %d" % (len(solr_docs), solr_response.status_code)
+    if len(changes) > 0:
+      apply(changes)
+      metrics.inc('stage_items_total', len(changes), stage='changes')
+      print "applied %d changes from %s, now at sequence %s" % (len(changes), couchdb_url, response['last_seq'])
     
-      if len(rows) < COUCHDB_BULK_SIZE: # done reading from couchdb
-        break
+    state[couchdb_url] = response['last_seq']
+    save_state(state)
     
-      last_row = rows[-1]
-      params.update({'startkey'  : json.dumps(last_row['doc']['_id']), 'skip' : 1})
-  print "Optimized solr, response was %d" % (requests.get(SOLR_URL + '/update?commit=true&optimize=true').status_code)
+    if len(changes) == 0 and not follow:
+      break
+
+def index_changes():
+  state = load_state()
+  # state files from before there was a choice don't have it, and were indexed with repeat
+  if state.get('hint_weighting', 'repeat') != weighting:
+    sys.exit("the last full run indexed with --hint-weighting %s, so switching needs a full run" %\
+        state.get('hint_weighting', 'repeat'))
+  followers = [gevent.spawn(follow_changes, couchdb_url, lambda changes, doc_type=doc_type : apply_changes(changes, doc_type),\
+      state) for (couchdb_url, doc_type) in SOURCES]
+  for follower in gevent.iwait(followers):
+    # a failed follower hasn't saved the sequence it failed at, so the next run picks up from there
+    if not follower.successful():
+      gevent.killall(followers)
+      raise follower.exception
+  print "Committed solr, response was %d" %\
+      (check_solr_response(couchdb_client.get(SOLR_URL + '/update?commit=true')).status_code)
+
+def index_everything():
+  
+  # changes made while this runs get applied again by the next incremental run, which does no harm
+  state = dict((couchdb_url, couchdb_client.get(couchdb_url).json()['update_seq']) for (couchdb_url, doc_type) in SOURCES)
+  state['hint_weighting'] = weighting
+  
+  print "Deleting all docs in Solr"
+  delete_response = couchdb_client.post(SOLR_URL + '/update/json', params={'commit' : 'true'},\
+      headers={'Content-Type' : 'application/json'},data=json.dumps({'delete' : {'query' : '*:*'}}))
+  print "Response was",check_solr_response(delete_response).status_code
+  
+  # read both dbs, transform and post concurrently, with bounded queues in between so that a slow
+  # stage holds up the ones before it instead of piling up docs in memory
+  rows_queue = Queue(QUEUE_SIZE)
+  docs_queue = Queue(QUEUE_SIZE)
+  metrics.gauge_function('queue_depth', rows_queue.qsize, queue='rows')
+  metrics.gauge_function('queue_depth', docs_queue.qsize, queue='solr docs')
+  
+  readers = [gevent.spawn(read_rows, couchdb_url, doc_type, rows_queue)\
+      for (couchdb_url, doc_type) in SOURCES]
+  transformers = [gevent.spawn(transform_rows, rows_queue, docs_queue) for i in range(num_transformers)]
+  posters = [gevent.spawn(post_docs, docs_queue) for i in range(num_posters)]
+  
+  # each stage is told to stop once the one before it is done.  If any greenlet fails, the rest would
+  # wait on its queue forever, so they're all killed and the run fails without saving the state.
+  stages = readers + transformers + posters
+  for greenlet in gevent.iwait(stages):
+    if not greenlet.successful():
+      gevent.killall(stages)
+      raise greenlet.exception
+    if greenlet in readers and all(reader.ready() for reader in readers):
+      for transformer in transformers:
+        rows_queue.put(StopIteration)
+    if greenlet in transformers and all(transformer.ready() for transformer in transformers):
+      for poster in posters:
+        docs_queue.put(StopIteration)
+  
+  print "Optimized solr, response was %d" %\
+      (check_solr_response(couchdb_client.get(SOLR_URL + '/update?commit=true&optimize=true')).status_code)
+  point_queries_at(HINT_FIELDS[weighting])
+  
+  save_state(state)
+
+def main():
+  if mode == 'incremental':
+    index_changes()
+  else:
+    index_everything()
+
+profiling.wrap(globals(), ['rows_to_solr_docs', 'is_duplicate_related', 'enhance_with_full_hints', 'couch_row_to_solr_doc',\
+    'post_to_solr', 'apply_changes'])
 
 if __name__=='__main__':
   main()
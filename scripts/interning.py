@@ -0,0 +1,36 @@
+#
+# intern repeated strings as small integer ids, so that big batches hold each distinct string only once
+#
+
+class StringTable(object):
+
+  def __init__(self):
+    self.ids = {}
+    self.strings = []
+
+  def __len__(self):
+    return len(self.strings)
+
+  def intern(self, s):
+    try:
+      return self.ids[s]
+    except KeyError:
+      string_id = len(self.strings)
+      self.ids[s] = string_id
+      self.strings.append(s)
+      return string_id
+
+  def lookup(self, string_id):
+    return self.strings[string_id]
+
+# a single id packs into itself, and a pair of ids packs into one 64-bit key that can't collide with it
+# (ids must be less than 2^32 - 1)
+def pack_ids(ids):
+  if len(ids) == 1:
+    return ids[0]
+  return ((ids[0] + 1) << 32) | ids[1]
+
+def unpack_ids(key):
+  if (key >> 32) == 0:
+    return (key,)
+  return ((key >> 32) - 1, key & 0xFFFFFFFF)
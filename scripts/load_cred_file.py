@@ -1,18 +1,39 @@
 #!/usr/bin/env python
 # create a csv/mysql database from the given cred file in the local directory
 # 
-# ./load_cred_file.py --db [csv/mysql]
+# ./load_cred_file.py --db [csv/mysql/binary] [--workers N] [--metrics FILE]
+#     [--profile FILE] [--profile-mode sample/timing]
+#
+# with --db binary, only the blocks and hints needed later on are written to cred.bin (see cred_binary.py)
+#
+# with --workers N (csv only), the cred file is split into byte ranges aligned to line boundaries,
+# which are parsed in N processes and then merged back into cred.csv in their original order
+#
+# with --metrics FILE, the lines/s and the process's CPU time and memory are written to FILE (see metrics.py)
+#
+# with --profile FILE, parsing and loading are profiled into FILE (see profiling.py); with --workers N
+# the parsing happens in the worker processes, which aren't profiled
 #
 
-import sys, re, getopt
+import sys, os, re, getopt, time, shutil
+import progress, metrics, profiling
 
 BATCH_SIZE = 50000
 TOTAL_NUM_LINES = 153004874
+CHUNK_SIZE = 64 * 1024 * 1024 # bytes of the cred file per parallel task
 
-args = {'--db' : 'csv'}
-args.update(dict(getopt.getopt(sys.argv[1:], '', ['db='])[0]))
+args = {'--db' : 'csv', '--workers' : '1', '--metrics' : None, '--profile' : None, '--profile-mode' : 'sample'}
+args.update(dict(getopt.getopt(sys.argv[1:], '', ['db=', 'workers=', 'metrics=', 'profile=', 'profile-mode='])[0]))
 
 dbtype = args['--db']
+num_workers = int(args['--workers'])
+
+if num_workers > 1 and dbtype != 'csv':
+  sys.exit('--workers is only supported with --db csv')
+
+metrics.start(args['--metrics'])
+profiling.start(args['--profile'], args['--profile-mode'])
+
 if dbtype == 'mysql':
   import MySQLdb as mysqldb;
   conn = mysqldb.connect('koholint','adobe_leaks','adobe_leaks','adobe_leaks')
@@ -78,6 +99,8 @@ if dbtype == 'mysql':
   ]
   for sql_command in sql_commands:
 	cur.execute(sql_command)
+elif dbtype == 'binary':
+  import cred_scanner, cred_binary
 else: # csv
   import csv
   csvfile = open('cred.csv','wb')
@@ -97,7 +120,7 @@ def parse_line(line):
     line = line[:-3]
   return line.split('-|-') 
 
-def process_batch(lines):
+def parse_lines(lines):
   parsed_lines = [parse_line(line) for line in lines]
 
   parsed_lines = filter((lambda line: len(line) >= 5), parsed_lines) # empty lines
@@ -107,13 +130,107 @@ def process_batch(lines):
       print "found a line with too many fields, ignoring extra fields:",line
       line = line[:5]
 
-  load_parsed_lines(parsed_lines)
+  return parsed_lines
+
+def process_batch(lines):
+  load_parsed_lines(parse_lines(lines))
+
+def compute_chunks(filename, chunk_size):
+  # split the file into (start, end) byte ranges that always end just after a newline
+  file_size = os.path.getsize(filename)
+  chunks = []
+  with open(filename, 'rb') as f:
+    start = 0
+    while start < file_size:
+      f.seek(min(start + chunk_size, file_size))
+      f.readline() # advance to the end of the current line
+      end = min(f.tell(), file_size)
+      chunks.append((start, end))
+      start = end
+  return chunks
+
+def parse_chunk((chunk_idx, start, end)):
+  # runs in a worker process; writes its share of the csv to a part file, which the
+  # parent appends to cred.csv in order
+  part_filename = 'cred.csv.part%05d' % chunk_idx
+  numlines = 0
+  with open('cred', 'rb') as credfile, open(part_filename, 'wb') as partfile:
+    part_writer = csv.writer(partfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
+    credfile.seek(start)
+    buffer = []
+    while credfile.tell() < end:
+      line = credfile.readline()
+      if not line:
+        break
+      buffer.append(line)
+      if len(buffer) == BATCH_SIZE:
+        part_writer.writerows(parse_lines(buffer))
+        numlines += len(buffer)
+        del buffer[:]
+    if len(buffer) > 0:
+      part_writer.writerows(parse_lines(buffer))
+      numlines += len(buffer)
+  return (part_filename, numlines)
+
+def main_parallel():
+  import multiprocessing
+
+  start_time = time.time()
+  chunks = compute_chunks('cred', CHUNK_SIZE)
+  print 'split cred file into %d chunks, parsing with %d workers...' % (len(chunks), num_workers)
+
+  pool = multiprocessing.Pool(num_workers)
+  numlines = 0
+  progress_counter = progress.ProgressCounter('lines', TOTAL_NUM_LINES)
+
+  # imap returns results in the order of the chunks, so the output keeps the original order
+  for (part_filename, part_numlines) in pool.imap(parse_chunk, [(i,) + chunk for (i, chunk) in enumerate(chunks)]):
+    with open(part_filename, 'rb') as partfile:
+      shutil.copyfileobj(partfile, csvfile)
+    os.remove(part_filename)
+    numlines += part_numlines
+    progress_counter.add(part_numlines)
+
+  pool.close()
+  pool.join()
+  csvfile.close()
+  progress_counter.finish()
+
+  print 'done, parsed %d lines in %.1fs' % (numlines, time.time() - start_time)
+
+def main_binary():
+  start_time = time.time()
+  writer = cred_binary.CredBinaryWriter('cred.bin')
+  next_report = BATCH_SIZE
+  progress_counter = progress.ProgressCounter('records')
+
+  for (password, hint) in cred_scanner.scan_passwords_and_hints('cred'):
+    writer.add(password, hint)
+    if writer.num_records == next_report:
+      next_report += BATCH_SIZE
+      progress_counter.add(BATCH_SIZE)
+
+  writer.close()
+  progress_counter.add(writer.num_records % BATCH_SIZE)
+  progress_counter.finish()
+  print 'done, wrote %d records with %d unique blocks and %d unique hints in %.1fs' % \
+      (writer.num_records, len(writer.blocks.ids), len(writer.hints.ids), time.time() - start_time)
 
 def main():
 
+  if dbtype == 'binary':
+    main_binary()
+    return
+
+  if num_workers > 1:
+    main_parallel()
+    return
+
+  start_time = time.time()
   numlines = 0
   credfile = open('cred','rb')
   buffer = []
+  progress_counter = progress.ProgressCounter('lines', TOTAL_NUM_LINES)
 
   for line in credfile.xreadlines():
     buffer.append(line)
@@ -121,11 +238,17 @@ def main():
       process_batch(buffer)
       del buffer[:]
       numlines += BATCH_SIZE
-
-      print 'processed %d/%d (%.2f%%) lines from cred file so far...' % (numlines, TOTAL_NUM_LINES, (numlines * 100.0 / TOTAL_NUM_LINES))
+      progress_counter.add(BATCH_SIZE)
 
   if len(buffer) > 0:
     process_batch(buffer)
+    numlines += len(buffer)
+    progress_counter.add(len(buffer))
+  progress_counter.finish()
+
+  print 'done, parsed %d lines in %.1fs' % (numlines, time.time() - start_time)
+
+profiling.wrap(globals(), ['parse_lines', 'load_parsed_lines'])
 
 if __name__=='__main__':
   main()
@@ -0,0 +1,172 @@
+#
+# counters, gauges and latency histograms shared by all of the scripts, written out as periodic snapshots
+#
+# couchdb_client.py records every request (count, status, bytes, latency and retries per endpoint),
+# progress.py records the items done by each stage, and bulk_writer.py its batch size and concurrency.
+# Scripts add their own queue depths with gauge_function(), which is only called when a snapshot is taken.
+#
+# nothing is written unless the script calls start(filename), which all of them do for --metrics FILE.
+# From then on FILE is replaced with a new snapshot every SNAPSHOT_INTERVAL seconds, from a background
+# thread so that it keeps coming even while the greenlets are stuck, and once more at exit.  A FILE ending
+# in .prom gets the Prometheus text format (e.g. for node_exporter's textfile collector); anything else
+# gets JSON, where every counter also has its rate since the previous snapshot.
+#
+# every metric is a name plus labels:
+#
+#   metrics.inc('http_requests_total', endpoint='localhost:5984/block_hints3/_bulk_docs', status=201)
+#
+
+import os, json, time, bisect, threading, atexit, resource
+
+SNAPSHOT_INTERVAL = 10.0 # seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # seconds
+
+# updated from greenlets and read from the snapshot thread
+lock = threading.Lock()
+counters = {}
+gauges = {}
+gauge_functions = {}
+histograms = {}
+
+start_time = time.time()
+snapshot_lock = threading.Lock()
+snapshot_settings = {'filename' : None, 'last_time' : start_time, 'last_counters' : {}}
+
+def metric_key(name, labels):
+  return (name, tuple(sorted(labels.iteritems())))
+
+def inc(name, n=1, **labels):
+  key = metric_key(name, labels)
+  with lock:
+    counters[key] = counters.get(key, 0) + n
+
+def set_gauge(name, value, **labels):
+  key = metric_key(name, labels)
+  with lock:
+    gauges[key] = value
+
+def gauge_function(name, function, **labels):
+  # function() is the gauge's value, e.g. a queue's qsize
+  key = metric_key(name, labels)
+  with lock:
+    gauge_functions[key] = function
+
+class Histogram(object):
+
+  def __init__(self):
+    self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1) # the last one is +Inf
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+    self.count += 1
+    self.sum += value
+
+def observe(name, value, **labels):
+  key = metric_key(name, labels)
+  with lock:
+    try:
+      histogram = histograms[key]
+    except KeyError:
+      histogram = histograms[key] = Histogram()
+    histogram.observe(value)
+
+def process_gauges():
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return {
+    ('process_uptime_seconds', ()) : time.time() - start_time,
+    ('process_cpu_seconds', ()) : usage.ru_utime + usage.ru_stime,
+    ('process_max_rss_bytes', ()) : usage.ru_maxrss * 1024,
+    }
+
+def take_snapshot():
+  with lock:
+    counter_values = dict(counters)
+    gauge_values = dict(gauges)
+    functions = gauge_functions.items()
+    histogram_values = dict((key, (list(histogram.bucket_counts), histogram.count, histogram.sum))\
+        for (key, histogram) in histograms.iteritems())
+  for (key, function) in functions:
+    gauge_values[key] = function()
+  gauge_values.update(process_gauges())
+  return (counter_values, gauge_values, histogram_values)
+
+def labels_dict(labels):
+  return dict((label, str(value)) for (label, value) in labels)
+
+def format_json((counter_values, gauge_values, histogram_values), now):
+  elapsed = max(now - snapshot_settings['last_time'], 1e-6)
+  last_counters = snapshot_settings['last_counters']
+  return json.dumps({
+    'time' : now,
+    'counters' : [{'name' : name, 'labels' : labels_dict(labels), 'value' : value,\
+        'rate' : (value - last_counters.get((name, labels), 0)) / elapsed}\
+        for ((name, labels), value) in sorted(counter_values.iteritems())],
+    'gauges' : [{'name' : name, 'labels' : labels_dict(labels), 'value' : value}\
+        for ((name, labels), value) in sorted(gauge_values.iteritems())],
+    'histograms' : [{'name' : name, 'labels' : labels_dict(labels), 'count' : count, 'sum' : total,\
+        'buckets' : dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], bucket_counts))}\
+        for ((name, labels), (bucket_counts, count, total)) in sorted(histogram_values.iteritems())],
+    }, indent=1)
+
+def prometheus_labels(labels):
+  if not labels:
+    return ''
+  escape = lambda value : str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return '{' + ','.join('%s="%s"' % (label, escape(value)) for (label, value) in labels) + '}'
+
+def format_prometheus((counter_values, gauge_values, histogram_values), now):
+  lines = []
+  typed_names = set()
+  def add_type(name, metric_type):
+    if name not in typed_names:
+      typed_names.add(name)
+      lines.append('# TYPE %s %s' % (name, metric_type))
+
+  for ((name, labels), value) in sorted(counter_values.iteritems()):
+    add_type(name, 'counter')
+    lines.append('%s%s %s' % (name, prometheus_labels(labels), value))
+  for ((name, labels), value) in sorted(gauge_values.iteritems()):
+    add_type(name, 'gauge')
+    lines.append('%s%s %s' % (name, prometheus_labels(labels), value))
+  for ((name, labels), (bucket_counts, count, total)) in sorted(histogram_values.iteritems()):
+    add_type(name, 'histogram')
+    cumulative = 0
+    for (bound, bucket_count) in zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], bucket_counts):
+      cumulative += bucket_count
+      lines.append('%s_bucket%s %d' % (name, prometheus_labels(labels + (('le', bound),)), cumulative))
+    lines.append('%s_sum%s %s' % (name, prometheus_labels(labels), total))
+    lines.append('%s_count%s %d' % (name, prometheus_labels(labels), count))
+  return '\n'.join(lines) + '\n'
+
+def write_snapshot():
+  filename = snapshot_settings['filename']
+  if filename is None:
+    return
+  with snapshot_lock: # the last snapshot at exit can overlap with a periodic one
+    snapshot = take_snapshot()
+    now = time.time()
+    text = (format_prometheus if filename.endswith('.prom') else format_json)(snapshot, now)
+    snapshot_settings['last_time'] = now
+    snapshot_settings['last_counters'] = snapshot[0]
+
+    # written to a temp file and renamed, so that a reader never sees half a snapshot
+    with open(filename + '.tmp', 'w') as f:
+      f.write(text)
+    os.rename(filename + '.tmp', filename)
+
+def write_snapshots(interval):
+  while True:
+    time.sleep(interval)
+    write_snapshot()
+
+def start(filename, interval=SNAPSHOT_INTERVAL):
+  # does nothing if filename is None, so scripts can pass their --metrics argument straight in
+  if filename is None:
+    return
+  snapshot_settings['filename'] = filename
+  thread = threading.Thread(target=write_snapshots, args=(interval,))
+  thread.daemon = True
+  thread.start()
+  atexit.register(write_snapshot)
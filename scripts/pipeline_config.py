@@ -0,0 +1,39 @@
+#
+# where the scripts find CouchDB and Solr
+#
+# by default every script talks to the servers hard-coded in it.  Setting $PIPELINE_CONFIG to a JSON
+# file overrides them, e.g. to run a stage against fake_server.py:
+#
+#   {
+#     "couchdb" : "http://localhost:7000",
+#     "shards" : ["http://localhost:7000/blocks_sharded0", "http://localhost:7000/blocks_sharded1"],
+#     "solr" : "http://localhost:7000/solr",
+#     "db_names" : {"block_summaries3" : "block_summaries"}
+#   }
+#
+# "couchdb" replaces the server of the single (unsharded) dbs, "shards" replaces the whole list of
+# blocks_sharded dbs, and "db_names" renames dbs on the "couchdb" server.  Anything left out keeps
+# the script's default.
+#
+
+import os, json
+
+CONFIG_ENV_VAR = 'PIPELINE_CONFIG'
+
+def load_config():
+  filename = os.environ.get(CONFIG_ENV_VAR)
+  if not filename:
+    return {}
+  with open(filename) as f:
+    return json.load(f)
+
+config = load_config()
+
+def couchdb_url(db_name, default_server='http://localhost:5984'):
+  return config.get('couchdb', default_server) + '/' + config.get('db_names', {}).get(db_name, db_name)
+
+def shard_urls(default_urls):
+  return config.get('shards', default_urls)
+
+def solr_url(default_url='http://localhost:8983/solr'):
+  return config.get('solr', default_url)
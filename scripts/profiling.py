@@ -0,0 +1,131 @@
+#
+# optional profiling of the scripts' hot functions, written as collapsed stacks for flamegraph.pl
+#
+# every script takes --profile FILE [--profile-mode sample/timing].  Without --profile nothing here is
+# installed, so the scripts run exactly as before.
+#
+# with --profile-mode sample (the default), a SIGPROF timer interrupts the process every SAMPLE_INTERVAL
+# seconds of CPU time and counts the whole Python stack of whichever greenlet is running.  It costs about
+# the same however often the hot functions are called, but only shows where CPU time goes.
+#
+# with --profile-mode timing, the functions each script passes to wrap() are timed on every call, and
+# switches between greenlets are traced, so that each function's time is split into time spent running
+# and time its greenlet was switched out (waiting for I/O, or for other greenlets).  That costs a couple
+# of microseconds per call, so it's best kept off of functions called once per line of the cred file.
+#
+# either way, every stack starts with the stage (the script's name) and the greenlet, named after the
+# function it was spawned with:
+#
+#   index_docs_in_solr;transform_rows;rows_to_solr_docs;couch_row_to_solr_doc 81234
+#   index_docs_in_solr;transform_rows;rows_to_solr_docs;enhance_with_full_hints;[switched out] 50310
+#
+# values are samples in sample mode and microseconds in timing mode.  FILE is written at exit.
+#
+# with compute_optimized_couchdb.py --cpu-workers, split_doc_into_summary_and_details runs in the worker
+# processes, which don't write a profile; the time shows up as the greenlets waiting in split_docs.
+#
+
+import os, sys, time, signal, atexit, functools
+import greenlet
+
+SAMPLE_INTERVAL = 0.005 # seconds of CPU time
+SWITCHED_OUT = '[switched out]'
+
+settings = {'mode' : None, 'stage' : os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'}
+stack_totals = {} # collapsed stack -> samples or microseconds
+greenlet_states = {} # greenlet -> GreenletState, for the greenlets inside a timed function
+
+def greenlet_name(current):
+  if current.parent is None:
+    return 'main'
+  run = getattr(current, '_run', None) # what a gevent Greenlet was spawned with
+  return getattr(run, '__name__', None) or type(current).__name__
+
+def add_to_stack(stack, amount):
+  stack_totals[stack] = stack_totals.get(stack, 0) + amount
+
+def sample(signum, frame):
+  names = []
+  while frame is not None:
+    names.append('%s:%s' % (os.path.splitext(os.path.basename(frame.f_code.co_filename))[0], frame.f_code.co_name))
+    frame = frame.f_back
+  names.append(greenlet_name(greenlet.getcurrent()))
+  names.append(settings['stage'])
+  add_to_stack(';'.join(reversed(names)), 1)
+
+class GreenletState(object):
+
+  def __init__(self, current):
+    self.path = settings['stage'] + ';' + greenlet_name(current)
+    self.frames = [] # [stack, start time, switched out time at the start, children's time, children's switched out time]
+    self.switched_out_time = 0.0
+    self.switched_out_at = None
+
+def trace_switch(event, (origin, target)):
+  now = time.time()
+  state = greenlet_states.get(origin)
+  if state is not None:
+    state.switched_out_at = now
+  state = greenlet_states.get(target)
+  if state is not None and state.switched_out_at is not None:
+    state.switched_out_time += now - state.switched_out_at
+    state.switched_out_at = None
+
+def timed(function):
+  name = function.__name__
+
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    current = greenlet.getcurrent()
+    state = greenlet_states.get(current)
+    if state is None:
+      state = greenlet_states[current] = GreenletState(current)
+    stack = (state.frames[-1][0] if state.frames else state.path) + ';' + name
+    frame = [stack, time.time(), state.switched_out_time, 0.0, 0.0]
+    state.frames.append(frame)
+    try:
+      return function(*args, **kwargs)
+    finally:
+      elapsed = time.time() - frame[1]
+      switched_out = state.switched_out_time - frame[2]
+      state.frames.pop()
+      add_to_stack(stack, int(((elapsed - switched_out) - (frame[3] - frame[4])) * 1e6))
+      add_to_stack(stack + ';' + SWITCHED_OUT, int((switched_out - frame[4]) * 1e6))
+      if state.frames:
+        state.frames[-1][3] += elapsed
+        state.frames[-1][4] += switched_out
+      else:
+        del greenlet_states[current]
+
+  return wrapper
+
+def wrap(namespace, names):
+  # replaces the named functions in namespace (a script's globals()) with timed versions, in timing mode only
+  if settings['mode'] != 'timing':
+    return
+  for name in names:
+    namespace[name] = timed(namespace[name])
+
+def write_profile(filename):
+  if settings['mode'] == 'sample':
+    signal.setitimer(signal.ITIMER_PROF, 0, 0) # so that no sample comes in while the totals are written
+  with open(filename, 'w') as f:
+    for (stack, total) in sorted(stack_totals.iteritems()):
+      if total > 0:
+        f.write('%s %d\n' % (stack, total))
+
+def start(filename, mode='sample'):
+  # does nothing if filename is None, so scripts can pass their --profile argument straight in
+  if filename is None:
+    return
+  if mode not in ('sample', 'timing'):
+    sys.exit('unknown --profile-mode %s' % mode)
+  settings['mode'] = mode
+
+  if mode == 'sample':
+    signal.signal(signal.SIGPROF, sample)
+    signal.siginterrupt(signal.SIGPROF, False) # restart system calls instead of failing them with EINTR
+    signal.setitimer(signal.ITIMER_PROF, SAMPLE_INTERVAL, SAMPLE_INTERVAL)
+  else:
+    greenlet.settrace(trace_switch)
+  atexit.register(write_profile, filename)
@@ -0,0 +1,44 @@
+#
+# progress counter that any number of greenlets can add to, printing a single '\r' status line
+#
+# the total can be set (or corrected) after counting has started, e.g. once the size of the input
+# is known.  Output is throttled to PRINT_INTERVAL, so counting in a tight loop stays cheap.
+#
+# the counts also go to metrics.py, as stage_items_total and stage_items_expected labelled by stage,
+# so that the --metrics snapshots show every stage's throughput.
+#
+
+import sys, time
+import metrics
+
+PRINT_INTERVAL = 0.5 # seconds
+
+class ProgressCounter(object):
+
+  def __init__(self, label, total=0):
+    self.label = label
+    self.total = total
+    self.count = 0
+    self.start_time = time.time()
+    self.last_print_time = 0
+
+  def add(self, n=1):
+    self.count += n
+    metrics.inc('stage_items_total', n, stage=self.label)
+    now = time.time()
+    if now - self.last_print_time >= PRINT_INTERVAL:
+      self.last_print_time = now
+      self.write('\r')
+
+  def write(self, end):
+    metrics.set_gauge('stage_items_expected', self.total, stage=self.label)
+    elapsed = max(time.time() - self.start_time, 1e-6)
+    if self.total > 0:
+      sys.stdout.write(' > %s: %d/%d (%.2f%%), %.0f/s%s' %\
+          (self.label, self.count, self.total, self.count * 100.0 / self.total, self.count / elapsed, end))
+    else:
+      sys.stdout.write(' > %s: %d, %.0f/s%s' % (self.label, self.count, self.count / elapsed, end))
+    sys.stdout.flush()
+
+  def finish(self):
+    self.write('\n')
@@ -0,0 +1,38 @@
+#
+# consistent-hash routing of blocks to the blocks_sharded CouchDBs
+#
+# compute_couchdb_from_csv.py uses this to decide where a block's docs are written, and the later
+# scripts use it to send a per-block lookup to the one shard that has the block.  Shards are hashed
+# by their position in the list rather than by URL, because the scripts reach the same shards
+# through different URLs.
+#
+
+import hashlib, bisect
+
+VIRTUAL_NODES_PER_SHARD = 100
+
+def hash_key(key):
+  if isinstance(key, unicode):
+    key = key.encode('utf-8')
+  return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+class HashRing(object):
+
+  def __init__(self, num_shards, virtual_nodes=VIRTUAL_NODES_PER_SHARD):
+    ring = sorted([(hash_key('shard-%d-%d' % (shard, i)), shard) for shard in range(num_shards) for i in range(virtual_nodes)])
+    self.hashes = [point for (point, shard) in ring]
+    self.shards = [shard for (point, shard) in ring]
+
+  def shard_for(self, key):
+    idx = bisect.bisect(self.hashes, hash_key(key))
+    return self.shards[idx % len(self.shards)]
+
+rings = {}
+
+def shard_for_block(block, urls):
+  # returns the url, from the given list of shards, that the block belongs to
+  try:
+    ring = rings[len(urls)]
+  except KeyError:
+    ring = rings[len(urls)] = HashRing(len(urls))
+  return urls[ring.shard_for(block)]